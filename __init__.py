@@ -1,2 +1,33 @@
+import importlib
+
 from .models import *
-from .graph_driver import *
\ No newline at end of file
+from .graph_driver import *
+
+# Heavy optional subsystems (plotting, seeding) are only imported on first attribute access
+_LAZY_MODULES = ['visualization', 'seeding', 'query_cache', 'columnar', 'sync', 'sharding', 'profiling', 'serialization', 'bulk_loader']
+_LAZY_ATTRS = {
+    'visualize': 'visualization',
+    'StoryGraph': 'visualization',
+    'parse_document': 'seeding',
+    'iter_document_batches': 'seeding',
+    'seed_directory': 'seeding',
+    'QueryCache': 'query_cache',
+    'GraphSync': 'sync',
+    'ShardedGraphDriver': 'sharding',
+    'encode_batch': 'serialization',
+    'decode_batch': 'serialization',
+    'ParallelBulkLoader': 'bulk_loader',
+}
+
+def __getattr__(name):
+    if name in _LAZY_MODULES:
+        value = importlib.import_module("." + name, __name__)
+    elif name in _LAZY_ATTRS:
+        value = getattr(importlib.import_module("." + _LAZY_ATTRS[name], __name__), name)
+    else:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    globals()[name] = value # Cache so later lookups skip __getattr__
+    return value
+
+def __dir__():
+    return sorted(list(globals().keys()) + _LAZY_MODULES + list(_LAZY_ATTRS.keys()))
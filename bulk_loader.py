@@ -0,0 +1,126 @@
+import threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from .graph_driver import group_by, stable_partition
+    from .models import dedupe_nodes, dedupe_edges
+except:
+    print("Import error, assuming module called directly")
+    from graph_driver import group_by, stable_partition
+    from models import dedupe_nodes, dedupe_edges
+
+"""
+Parallel bulk loading
+
+ParallelBulkLoader writes a large set of nodes and edges through one GraphDBDriver from a
+pool of worker threads, scheduled so that no two concurrent transactions lock the same node.
+
+Node phase
+    Nodes are split into partitions by stable_partition(key). Partitions hold disjoint keys,
+    so every partition is merged in parallel.
+
+Edge phase (after every node is written)
+    Writing an edge locks both of its endpoint nodes, so an edge belongs to the (unordered) pair
+    of its endpoints' partitions. Pairs are scheduled in rounds using the circle method: within
+    a round no partition appears in two pairs, so concurrent batches never share an endpoint and
+    can't deadlock. Edges with both endpoints in one partition get their own round at the end.
+    Each round waits for the previous one to finish.
+
+    loader = ParallelBulkLoader(GraphDBDriver(max_connection_pool_size=16), workers=8)
+    report = loader.load(nodes, edges)
+
+There are twice as many partitions as workers by default, so each edge round has one pair per
+worker. Keep workers at or below the driver's max_connection_pool_size.
+"""
+class ParallelBulkLoader:
+    def __init__(self, driver, workers=4, batch_size=1000, partitions=None):
+        assert workers > 0, "Error: workers must be positive"
+        self.driver = driver
+        self.workers = workers
+        self.batch_size = batch_size
+        self.partitions = partitions if partitions else 2 * workers
+        pool_size = getattr(driver, 'pool_size', None)
+        if pool_size and workers > pool_size:
+            print("Warning: {} workers will queue for {} pooled connections".format(workers, pool_size))
+        self._lock = threading.Lock()
+        self.worker_stats = dict()
+
+    def partition(self, key):
+        return stable_partition(key, self.partitions)
+
+    # Loads nodes and then edges, returns the throughput report
+    def load(self, nodes, edges=()):
+        self.worker_stats = dict()
+        start = time.perf_counter()
+        report = {'nodes': self.load_nodes(nodes), 'edges': self.load_edges(edges) if edges else None}
+        report['seconds'] = time.perf_counter() - start
+        rows = report['nodes']['rows'] + (report['edges']['rows'] if edges else 0)
+        report['rows_per_second'] = rows / report['seconds'] if report['seconds'] else 0
+        report['workers'] = self.worker_report()
+        print("Loaded {} rows in {:.1f}s ({:.0f} rows/s)".format(rows, report['seconds'], report['rows_per_second']))
+        return report
+
+    def load_nodes(self, nodes):
+        nodes = dedupe_nodes(nodes)
+        routed = group_by(nodes, lambda node: self.partition(node.key))
+        start = time.perf_counter()
+        created = sum(self._run_round([(lambda part=part: self._merge(self.driver.merge_nodes, part)) for part in routed.values()]))
+        return self._phase_report(len(nodes), created, len(routed), start)
+
+    def load_edges(self, edges):
+        edges = dedupe_edges(edges)
+        routed = group_by(edges, lambda edge: tuple(sorted((self.partition(edge.source_key), self.partition(edge.dest_key)))))
+        start = time.perf_counter()
+        created = 0
+        for pairs in pair_rounds(self.partitions):
+            tasks = [(lambda part=routed[pair]: self._merge(self.driver.merge_edges, part)) for pair in pairs if pair in routed]
+            if tasks:
+                created += sum(self._run_round(tasks))
+        return self._phase_report(len(edges), created, len(routed), start)
+
+    # Runs one round of tasks on the thread pool and waits for all of them
+    def _run_round(self, tasks):
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="loader") as executor:
+            futures = [executor.submit(task) for task in tasks]
+            return [future.result() for future in futures]
+
+    # Merges a partition's items, recording rows and time for the worker thread that ran it
+    def _merge(self, merge_fn, items):
+        start = time.perf_counter()
+        created = merge_fn(items, batch_size=self.batch_size)
+        seconds = time.perf_counter() - start
+        with self._lock:
+            stats = self.worker_stats.setdefault(threading.current_thread().name, {'rows': 0, 'tasks': 0, 'seconds': 0.0})
+            stats['rows'] += len(items)
+            stats['tasks'] += 1
+            stats['seconds'] += seconds
+        return created
+
+    @staticmethod
+    def _phase_report(rows, created, tasks, start):
+        seconds = time.perf_counter() - start
+        return {'rows': rows, 'created': created, 'tasks': tasks, 'seconds': seconds, 'rows_per_second': rows / seconds if seconds else 0}
+
+    # Rows per second per worker thread, over the time each worker spent writing
+    def worker_report(self):
+        with self._lock:
+            report = {name: dict(stats) for name, stats in self.worker_stats.items()}
+        for stats in report.values():
+            stats['rows_per_second'] = stats['rows'] / stats['seconds'] if stats['seconds'] else 0
+        return report
+
+# Schedules every unordered pair of partitions (including (p, p)) into rounds of disjoint pairs
+# Circle method: partition 0 stays fixed while the others rotate, giving n - 1 rounds for even n
+def pair_rounds(n):
+    players = list(range(n)) + ([None] if n % 2 else [])
+    rounds = []
+    for _ in range(len(players) - 1):
+        pairs = []
+        for i in range(len(players) // 2):
+            a, b = players[i], players[-1 - i]
+            if a is not None and b is not None:
+                pairs.append((min(a, b), max(a, b)))
+        rounds.append(pairs)
+        players = [players[0], players[-1]] + players[1:-1]
+    rounds.append([(p, p) for p in range(n)])
+    return rounds
@@ -0,0 +1,202 @@
+from neo4j.graph import Node as GraphNode, Relationship as GraphRelationship
+from neo4j.time import Date, DateTime, Time, Duration
+
+try:
+    from .query_cache import CachedNode, CachedRelationship
+except:
+    print("Import error, assuming module called directly")
+    from query_cache import CachedNode, CachedRelationship
+
+"""
+Columnar query results
+
+Converts streams of neo4j Records into typed columns in fixed-size batches, so large
+results can go straight into pyarrow Tables or pandas DataFrames without building a
+model object or dict per row. Used by GraphDBDriver.raw_query/structured_query/stream_query
+with format="arrow" or format="pandas".
+
+Columns are named after the RETURN keys. Graph objects are flattened into prefixed columns,
+with metadata under a "__" prefix so it can't collide with a property of the same name:
+    node -> node.__id, node.__labels, node.<property>...
+    edge -> edge.__id, edge.__type, edge.__start, edge.__end, edge.__start_key, edge.__end_key, edge.<property>...
+neo4j temporal values are converted to native datetimes so they become timestamp columns.
+
+pyarrow and pandas are optional and only imported when a columnar format is requested.
+"""
+COLUMNAR_FORMATS = ['arrow', 'pandas']
+DEFAULT_BATCH_SIZE = 10000
+
+METADATA_PREFIX = "__"
+
+NODE_TYPES = (GraphNode, CachedNode)
+RELATIONSHIP_TYPES = (GraphRelationship, CachedRelationship)
+TEMPORAL_TYPES = (Date, DateTime, Time)
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError("format='arrow' requires pyarrow (pip install pyarrow)")
+    return pyarrow
+
+def _import_pandas():
+    try:
+        import pandas
+    except ImportError:
+        raise ImportError("format='pandas' requires pandas (pip install pandas)")
+    return pandas
+
+def has_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        return False
+    return True
+
+def check_format(format):
+    assert format is None or format in COLUMNAR_FORMATS, "Error: unsupported result format " + str(format)
+
+
+# Accumulates record values into per-column lists
+class ColumnBuilder:
+    def __init__(self):
+        self.columns = dict() # column name -> list of values
+        self.rows = 0
+
+    def __len__(self):
+        return self.rows
+
+    def append(self, record):
+        for key, value in zip(record.keys(), record.values()):
+            if isinstance(value, NODE_TYPES):
+                meta = key + "." + METADATA_PREFIX
+                self._set(meta + "id", value.id)
+                self._set(meta + "labels", sorted(value.labels))
+                self._set_properties(key, value)
+            elif isinstance(value, RELATIONSHIP_TYPES):
+                meta = key + "." + METADATA_PREFIX
+                self._set(meta + "id", value.id)
+                self._set(meta + "type", value.type)
+                self._set(meta + "start", value.start_node.id if value.start_node is not None else None)
+                self._set(meta + "end", value.end_node.id if value.end_node is not None else None)
+                self._set(meta + "start_key", value.start_node.get('key') if value.start_node is not None else None)
+                self._set(meta + "end_key", value.end_node.get('key') if value.end_node is not None else None)
+                self._set_properties(key, value)
+            else:
+                self._set(key, value)
+        self.rows += 1
+        for name, values in self.columns.items():
+            # Pad columns this record had no value for
+            if len(values) < self.rows:
+                values.append(None)
+            # Two values for one row (e.g. RETURN keys "node" and "node.name") would shift every later row
+            assert len(values) == self.rows, "Error: more than one value for column " + name
+
+    def _set_properties(self, key, entity):
+        for prop, prop_value in entity.items():
+            assert not prop.startswith(METADATA_PREFIX), "Error: property {} of {} clashes with metadata columns".format(prop, key)
+            self._set(key + "." + prop, prop_value)
+
+    def _set(self, name, value):
+        if isinstance(value, TEMPORAL_TYPES):
+            value = value.to_native()
+        elif isinstance(value, Duration):
+            value = str(value)
+        values = self.columns.get(name)
+        if values is None:
+            values = self.columns[name] = [None] * self.rows # Column first seen mid-batch
+        values.append(value)
+
+    # Returns the accumulated (columns, rows) and resets the builder
+    def take(self):
+        columns, rows = self.columns, self.rows
+        self.columns, self.rows = dict(), 0
+        return columns, rows
+
+
+# Arrow Conversion
+def to_arrow_array(values):
+    pa = _import_pyarrow()
+    try:
+        return pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Mixed types in one column, fall back to strings
+        return pa.array([None if value is None else str(value) for value in values], type=pa.string())
+
+def columns_to_arrow(columns, rows):
+    pa = _import_pyarrow()
+    if not columns:
+        return pa.table(dict())
+    return pa.table({name: to_arrow_array(values) for name, values in columns.items()})
+
+# Unifies per-batch Arrow tables whose columns or inferred types differ into one table
+def concat_arrow(tables):
+    pa = _import_pyarrow()
+    tables = [table for table in tables if table.num_rows > 0]
+    if not tables:
+        return pa.table(dict())
+    names = []
+    types = dict()
+    for table in tables:
+        for field in table.schema:
+            if field.name not in types:
+                names.append(field.name)
+                types[field.name] = field.type
+            elif pa.types.is_null(types[field.name]):
+                types[field.name] = field.type
+    chunks = {name: [] for name in names}
+    for table in tables:
+        for name in names:
+            if name not in table.column_names or pa.types.is_null(table.schema.field(name).type):
+                chunks[name].append(pa.nulls(table.num_rows, type=types[name]))
+                continue
+            column = table.column(name).combine_chunks()
+            if column.type != types[name]:
+                try:
+                    column = column.cast(types[name])
+                except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                    column = pa.array([None if value is None else str(value) for value in column.to_pylist()], type=pa.string())
+                    types[name] = pa.string()
+            chunks[name].append(column)
+    # Columns that fell back to strings need every chunk cast to match
+    columns = dict()
+    for name in names:
+        arrays = [array if array.type == types[name] else array.cast(types[name]) for array in chunks[name]]
+        columns[name] = pa.chunked_array(arrays, type=types[name])
+    return pa.table(columns)
+
+def columns_to_pandas(columns, rows):
+    if has_pyarrow():
+        return columns_to_arrow(columns, rows).to_pandas()
+    pd = _import_pandas()
+    return pd.DataFrame(columns, index=range(rows))
+
+def convert_columns(columns, rows, format):
+    if format == 'arrow':
+        return columns_to_arrow(columns, rows)
+    return columns_to_pandas(columns, rows)
+
+
+# Record Stream Conversion
+# Yields one Arrow table or DataFrame per batch_size records
+def iter_columnar_batches(records, format, batch_size=DEFAULT_BATCH_SIZE):
+    assert format in COLUMNAR_FORMATS, "Error: unsupported columnar format " + str(format)
+    builder = ColumnBuilder()
+    for record in records:
+        builder.append(record)
+        if len(builder) >= batch_size:
+            yield convert_columns(*builder.take(), format)
+    if len(builder) > 0:
+        yield convert_columns(*builder.take(), format)
+
+# Converts a whole record stream into a single Arrow table or DataFrame
+# Each batch is converted to Arrow as soon as it fills, so Python values never outlive their batch
+def records_to_columnar(records, format, batch_size=DEFAULT_BATCH_SIZE):
+    assert format in COLUMNAR_FORMATS, "Error: unsupported columnar format " + str(format)
+    if format == 'arrow' or has_pyarrow():
+        table = concat_arrow(list(iter_columnar_batches(records, 'arrow', batch_size=batch_size)))
+        return table if format == 'arrow' else table.to_pandas()
+    # pandas without pyarrow
+    pd = _import_pandas()
+    frames = list(iter_columnar_batches(records, 'pandas', batch_size=batch_size))
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
@@ -1,25 +1,68 @@
-import datetime, os
+import datetime, hashlib, os, random, threading, time
+from contextlib import ExitStack, contextmanager
 
 from neo4j import GraphDatabase
 from neo4j.data import Record
-from dotenv import dotenv_values, load_dotenv
+from neo4j.exceptions import Neo4jError, DriverError, ServiceUnavailable, SessionExpired, TransientError
 try:
-    from .models import Node, Entity, Interaction, Attribute, Edge
+    from .models import Node, Entity, Interaction, Attribute, Edge, dedupe_nodes, dedupe_edges, content_hash, native_value, INTERNAL_PROPERTIES, MERGE_MANAGED_PROPERTIES
+    from .query_cache import freeze_records, thaw_records, is_write_query
+    from .columnar import check_format, records_to_columnar, iter_columnar_batches, DEFAULT_BATCH_SIZE
 except:
     print("Import error, assuming module called directly")
-    from models import Node, Entity, Interaction, Attribute, Edge
-
-# config = dotenv_values(".env")  # config = {"USER": "foo", "EMAIL": "foo@example.org"}
-load_dotenv()
-config = {
-    'REMOTE_GRAPH_URI': os.getenv('REMOTE_GRAPH_URI'),
-    'REMOTE_GRAPH_USER': os.getenv('REMOTE_GRAPH_USER'),
-    'REMOTE_GRAPH_PWD': os.getenv('REMOTE_GRAPH_PWD'),
-    'LOCAL_GRAPH_URI': os.getenv('LOCAL_GRAPH_URI'),
-    'LOCAL_GRAPH_USER': os.getenv('LOCAL_GRAPH_USER'),
-    'LOCAL_GRAPH_PWD': os.getenv('LOCAL_GRAPH_PWD'),
+    from models import Node, Entity, Interaction, Attribute, Edge, dedupe_nodes, dedupe_edges, content_hash, native_value, INTERNAL_PROPERTIES, MERGE_MANAGED_PROPERTIES
+    from query_cache import freeze_records, thaw_records, is_write_query
+    from columnar import check_format, records_to_columnar, iter_columnar_batches, DEFAULT_BATCH_SIZE
+
+# Node models by their type property, used to parse returned nodes
+NODE_MODELS = {
+    'entity': Entity,
+    'interaction': Interaction,
+    'attribute': Attribute,
 }
-assert len(config) > 0, "Error: Cannot read .env file"
+
+# Every upload stamps nodes and edges with the server time (ms) they were last written at
+# sync.py uses it as a per-label watermark to pull only what changed. The time is taken when the
+# statement starts, not when it commits, so sync only trusts stamps older than a safety lag
+INGESTED_AT = 'ingested_at'
+
+CONFIG_KEYS = [
+    'REMOTE_GRAPH_URI',
+    'REMOTE_GRAPH_USER',
+    'REMOTE_GRAPH_PWD',
+    'LOCAL_GRAPH_URI',
+    'LOCAL_GRAPH_USER',
+    'LOCAL_GRAPH_PWD',
+]
+
+# Reads the graph credentials from the environment and .env file
+# Called when a driver is constructed rather than at import time, so importing this module stays cheap
+def load_config():
+    from dotenv import load_dotenv
+    load_dotenv()
+    config = {key: os.getenv(key) for key in CONFIG_KEYS}
+    assert len(config) > 0, "Error: Cannot read .env file"
+    return config
+
+# Backwards compatibility for code reading the old module-level config
+def __getattr__(name):
+    if name == 'config':
+        return load_config()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+# Errors worth retrying: lost connections, expired sessions, deadlocks and other transient server errors
+RETRYABLE_ERRORS = (ServiceUnavailable, SessionExpired, TransientError)
+
+# Raised by GraphDBDriver when the database can't be reached at startup
+class GraphConnectionError(Exception):
+    pass
+
+# Raised by raw_query when a query fails with a permanent error or runs out of retries
+class QueryError(Exception):
+    def __init__(self, message, query=None, retries=0):
+        super().__init__(message)
+        self.query = query
+        self.retries = retries
 
 class GraphDBDriver:
     """
@@ -28,9 +71,34 @@ class GraphDBDriver:
         query: makes a direct cypher query
         upload_nodes: Upload an iterable of nodes to the database
         upload_edges: Upload an iterable of edges to the database
+        merge_nodes: Batched upsert of nodes by key (for content-addressed keys)
+        merge_edges: Batched upsert of edges between keyed nodes
+        upload_nodes_diff: Re-upload that only writes new nodes and changed properties
+        bfs / shortest_path / all_paths: Frontier-batched traversals between nodes
+        delete_nodes / delete_by_parent_doc / delete_edges: Chunked deletes and document retraction
+        pool_stats: Session concurrency, pool saturation and retry counters
 
+    Pass a query_cache.QueryCache as cache to serve reads made with use_cache=True from disk.
+
+    Connections come from a pool of at most max_connection_pool_size, waiting up to
+    connection_acquisition_timeout seconds for a free one and recycling connections older than
+    max_connection_lifetime seconds. Connectivity is checked on construction (verify=False skips it).
+    raw_query retries read queries that fail transiently up to max_retries times with exponential
+    backoff starting at retry_delay seconds, and raises QueryError for anything else. Write queries
+    are never retried by raw_query: an auto-commit write may have committed before the error was
+    seen. Transactions in the upload, merge and delete methods are retried by the neo4j driver
+    itself (write_transaction).
     """
-    def __init__(self, remote=False):
+    def __init__(self, remote=False, config=None, cache=None, max_connection_pool_size=100, connection_acquisition_timeout=60,
+                 max_connection_lifetime=3600, verify=True, max_retries=3, retry_delay=0.5, max_retry_delay=8):
+        config = config if config is not None else load_config()
+        self.cache = cache
+        self.pool_size = max_connection_pool_size
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._stats_lock = threading.Lock()
+        self.stats = {'queries': 0, 'retries': 0, 'failures': 0, 'sessions': 0, 'in_flight': 0, 'max_in_flight': 0, 'acquisition_timeouts': 0}
         if remote:
             uri = config["REMOTE_GRAPH_URI"]
             user = config["REMOTE_GRAPH_USER"]
@@ -39,12 +107,20 @@ class GraphDBDriver:
             uri = config["LOCAL_GRAPH_URI"]
             user = config["LOCAL_GRAPH_USER"]
             password = config["LOCAL_GRAPH_PWD"]
+        self.uri = uri # Namespaces this driver's entries in a shared query cache
 
+        self.driver = None
         try:
-            self.driver = GraphDatabase.driver(uri, auth=(user, password))
+            self.driver = GraphDatabase.driver(uri, auth=(user, password),
+                max_connection_pool_size=max_connection_pool_size,
+                connection_acquisition_timeout=connection_acquisition_timeout,
+                max_connection_lifetime=max_connection_lifetime)
+            # Bad addresses and credentials otherwise only show up on the first query
+            if verify:
+                self.driver.verify_connectivity()
         except Exception as e:
-            self.driver = None
-            print("Failed to create the driver:", e) # TODO: Sometimes the driver is created succesfully but query fails with Cannot resolve address ___________
+            self.close()
+            raise GraphConnectionError("Failed to connect to {}: {}".format(uri, e)) from e
 
     def close(self):
         if self.driver:
@@ -66,30 +142,47 @@ class GraphDBDriver:
     def query_edge(self, edge, parse_nodes=False):
         return self.raw_query("MATCH (a:{} {{key: \"{}\"}})-[edge:{}]->(b:{} {{key: \"{}\"}}) RETURN edge".format(edge.source_type, edge.source_key, edge.label, edge.dest_type, edge.dest_key), parse_nodes=False)
 
-    # Returns a list of neo4j.data.Records
-    def raw_query(self, query, parse_nodes=False):
+    # Returns a list of neo4j.data.Records, raises QueryError if the query fails
+    # With use_cache=True, read queries are served from (and stored in) the driver's query cache
+    # With format="arrow" or "pandas", returns a pyarrow Table or DataFrame instead (see columnar.py)
+    def raw_query(self, query, parse_nodes=False, params=None, use_cache=False, format=None):
         assert self.driver, "Driver not initialized!"
-        session = None
+        check_format(format)
+        write = is_write_query(query)
+        use_cache = use_cache and self.cache is not None and not write
+        # Uncached columnar results are converted straight from the result stream
+        stream_columns = format is not None and not use_cache
         response = None
-        try: 
-            session = self.driver.session()
-            response = list(session.run(query))
-        except Exception as e:
-            print("Query failed:", e)
-        finally: 
-            if session:
-                session.close()
+        if use_cache:
+            # Read before the query runs, so a write committed while it is in flight invalidates the result
+            epoch = self.cache.epoch()
+            cached = self.cache.get(query, params, namespace=self.uri)
+            if cached is not None:
+                response = thaw_records(cached)
         if response is None:
-            print("Warning: nothing returned for query:", query)
-            return None
-        if parse_nodes:
+            def run():
+                with self._session() as session:
+                    result = session.run(query, params or dict())
+                    return records_to_columnar(result, format) if stream_columns else list(result)
+            try:
+                response = self._with_retries(run, query, retry=not write)
+            finally:
+                if write:
+                    self._bump_epoch()
+            if use_cache:
+                self.cache.set(query, params, freeze_records(response), namespace=self.uri, epoch=epoch)
+        if stream_columns:
+            return response
+        elif format:
+            return records_to_columnar(response, format)
+        elif parse_nodes:
             return [self.record_to_models(record)['node'] for record in response]
         else:
             return response    
 
     # Semi-structured query
     # Returns a list of neo4j.data.Records
-    def structured_query(self, MATCH=None, WHERE=None, RETURN=None, LIMIT=10, parse_nodes=False):
+    def structured_query(self, MATCH=None, WHERE=None, RETURN=None, LIMIT=10, parse_nodes=False, params=None, use_cache=False, format=None):
         query_arr = []
         if MATCH:
             query_arr.append("MATCH " + MATCH)
@@ -103,7 +196,35 @@ class GraphDBDriver:
         
         query = "\n".join(query_arr)
         # print(query)
-        return self.raw_query(query, parse_nodes=parse_nodes)
+        return self.raw_query(query, parse_nodes=parse_nodes, params=params, use_cache=use_cache, format=format)
+
+    # Streams results in batches of batch_size, as lists of Records or as Arrow tables/DataFrames
+    # The session stays open until the generator is exhausted or closed
+    # Opening the stream (up to its first record) is retried like raw_query. Once records have been
+    # yielded a failure can't be retried without repeating them, so it is raised as QueryError
+    def stream_query(self, query, params=None, batch_size=DEFAULT_BATCH_SIZE, format=None):
+        assert self.driver, "Driver not initialized!"
+        check_format(format)
+        def start():
+            stack = ExitStack()
+            try:
+                session = stack.enter_context(self._session(fetch_size=batch_size))
+                result = session.run(query, params or dict())
+                result.peek() # Fetches the first records, so connection and query errors surface here
+                return stack, result
+            except BaseException:
+                stack.close()
+                raise
+        stack, result = self._with_retries(start, query, retry=not is_write_query(query))
+        with stack:
+            try:
+                if format:
+                    yield from iter_columnar_batches(result, format, batch_size=batch_size)
+                else:
+                    yield from batches(result, batch_size)
+            except (Neo4jError, DriverError) as e:
+                self._count('failures')
+                raise QueryError("Stream failed: {}".format(e), query=query) from e
         
     # Formats the 'WHERE' component of a Cypher Query from two datetimes and a target field name
     # Returns None if both start and end are empty
@@ -126,31 +247,237 @@ class GraphDBDriver:
         return " ".join(tokens)
             
     
+    # Traversal Methods
+    # Nodes can be passed as Node models or (key, type) tuples, and are returned as (key, type) tuples
+    # Each BFS level is expanded with one batched query per node type in the frontier, capped at
+    # max_fanout neighbors per node, so hub entities cost a bounded amount per level
+    def expand_frontier(self, frontier, direction='both', edge_labels=None, node_types=None, max_fanout=100, use_cache=False):
+        assert direction in TRAVERSAL_PATTERNS, "Error: direction must be one of " + str(list(TRAVERSAL_PATTERNS.keys()))
+        neighbors = {node: [] for node in frontier}
+        for node_type, typed_frontier in group_by(frontier, lambda node: node[1]).items():
+            query = "\n".join([
+                "UNWIND $keys AS k",
+                "MATCH (n:{} {{key: k}})".format(node_type),
+                "CALL {",
+                "    WITH n",
+                "    MATCH " + TRAVERSAL_PATTERNS[direction],
+                "    WHERE ($edge_labels IS NULL OR type(edge) IN $edge_labels) AND ($node_types IS NULL OR m.type IN $node_types)",
+                "    RETURN edge, m LIMIT $max_fanout",
+                "}",
+                "RETURN n.key AS key, type(edge) AS label, m.key AS neighbor, m.type AS neighbor_type, startNode(edge) = n AS outgoing",
+            ])
+            params = {
+                'keys': [key for key, _ in typed_frontier],
+                'edge_labels': list(edge_labels) if edge_labels else None,
+                'node_types': list(node_types) if node_types else None,
+                'max_fanout': max_fanout,
+            }
+            for record in self.raw_query(query, params=params, use_cache=use_cache):
+                neighbors[record['key'], node_type].append(((record['neighbor'], record['neighbor_type']), record['label'], record['outgoing']))
+        return neighbors
+
+    # Bounded breadth-first search from a start node or a list of start nodes
+    # Returns a dictionary with
+    #   levels: list of lists of nodes, levels[0] being the start nodes
+    #   parents: node -> (parent node, edge tuple) for reconstructing paths back to a start node
+    #   truncated: True if max_nodes stopped the search early
+    def bfs(self, start, max_depth=3, direction='both', edge_labels=None, node_types=None, max_fanout=100, max_nodes=10000, use_cache=False):
+        start = [node_key_type(node) for node in (start if type(start) == list else [start])]
+        visited = set(start)
+        parents = dict()
+        levels = [list(visited)]
+        truncated = False
+        for depth in range(max_depth):
+            frontier = levels[-1]
+            if not frontier or truncated:
+                break
+            next_level = []
+            for node, neighbors in self.expand_frontier(frontier, direction, edge_labels, node_types, max_fanout, use_cache).items():
+                for neighbor, label, outgoing in neighbors:
+                    if neighbor in visited:
+                        continue
+                    if len(visited) >= max_nodes:
+                        truncated = True
+                        break
+                    visited.add(neighbor)
+                    parents[neighbor] = (node, edge_tuple(node[0], neighbor[0], label, outgoing))
+                    next_level.append(neighbor)
+            levels.append(next_level)
+        return {'levels': levels, 'parents': parents, 'truncated': truncated}
+
+    # Bidirectional BFS, always expanding the smaller frontier
+    # Returns {'nodes': [...], 'edges': [(label, source_key, dest_key), ...]} or None if no path within max_depth
+    def shortest_path(self, source, target, max_depth=6, direction='both', edge_labels=None, node_types=None, max_fanout=100, use_cache=False):
+        source, target = node_key_type(source), node_key_type(target)
+        if source == target:
+            return {'nodes': [source], 'edges': []}
+        reverse = {'out': 'in', 'in': 'out', 'both': 'both'}[direction]
+        # node -> (previous node, edge tuple) on the forward and backward sides
+        forward, backward = {source: None}, {target: None}
+        forward_frontier, backward_frontier = [source], [target]
+        for depth in range(max_depth):
+            if not forward_frontier or not backward_frontier:
+                return None
+            expand_forward = len(forward_frontier) <= len(backward_frontier)
+            frontier = forward_frontier if expand_forward else backward_frontier
+            seen, other = (forward, backward) if expand_forward else (backward, forward)
+            next_frontier = []
+            meeting = None
+            expanded = self.expand_frontier(frontier, direction if expand_forward else reverse, edge_labels, node_types, max_fanout, use_cache)
+            for node, neighbors in expanded.items():
+                for neighbor, label, outgoing in neighbors:
+                    if neighbor in seen:
+                        continue
+                    seen[neighbor] = (node, edge_tuple(node[0], neighbor[0], label, outgoing))
+                    next_frontier.append(neighbor)
+                    if neighbor in other:
+                        meeting = neighbor
+                        break
+                if meeting:
+                    break
+            if meeting:
+                return join_paths(meeting, forward, backward)
+            if expand_forward:
+                forward_frontier = next_frontier
+            else:
+                backward_frontier = next_frontier
+        return None
+
+    # All simple paths from source to target with at most max_length edges, up to max_paths of them
+    # The neighborhood of source is explored level by level, then paths are enumerated client-side
+    # Returns a list of {'nodes': [...], 'edges': [...]} dictionaries, shortest first
+    def all_paths(self, source, target, max_length=3, direction='both', edge_labels=None, node_types=None, max_fanout=100, max_paths=100, max_nodes=10000, use_cache=False):
+        source, target = node_key_type(source), node_key_type(target)
+        adjacency = dict() # node -> [(neighbor, edge tuple)]
+        visited = {source}
+        frontier = [source]
+        for depth in range(max_length):
+            if not frontier:
+                break
+            next_frontier = []
+            for node, neighbors in self.expand_frontier(frontier, direction, edge_labels, node_types, max_fanout, use_cache).items():
+                adjacency[node] = [(neighbor, edge_tuple(node[0], neighbor[0], label, outgoing)) for neighbor, label, outgoing in neighbors]
+                for neighbor, _, _ in neighbors:
+                    # The target is never expanded since simple paths end there
+                    if neighbor not in visited and neighbor != target and len(visited) < max_nodes:
+                        visited.add(neighbor)
+                        next_frontier.append(neighbor)
+            frontier = next_frontier
+
+        # Hops from each explored node to the target, used to prune the enumeration
+        distance = {target: 0}
+        reverse_adjacency = dict()
+        for node, neighbors in adjacency.items():
+            for neighbor, _ in neighbors:
+                reverse_adjacency.setdefault(neighbor, []).append(node)
+        level = [target]
+        while level:
+            next_level = []
+            for node in level:
+                for previous in reverse_adjacency.get(node, []):
+                    if previous not in distance:
+                        distance[previous] = distance[node] + 1
+                        next_level.append(previous)
+            level = next_level
+
+        paths = []
+        def extend(node, nodes, edges):
+            if len(paths) >= max_paths:
+                return
+            if node == target:
+                paths.append({'nodes': list(nodes), 'edges': list(edges)})
+                return
+            for neighbor, edge in adjacency.get(node, []):
+                if neighbor in nodes or neighbor not in distance or len(edges) + 1 + distance[neighbor] > max_length:
+                    continue
+                nodes.append(neighbor)
+                edges.append(edge)
+                extend(neighbor, nodes, edges)
+                nodes.pop()
+                edges.pop()
+        if source in distance:
+            extend(source, [source], [])
+        return sorted(paths, key=lambda path: len(path['edges']))
+
     # Upload Methods
     # Node Methods
-    def upload_nodes(self, nodes):
+    # With diff=True, existing nodes are updated instead of skipped (see upload_nodes_diff)
+    def upload_nodes(self, nodes, diff=False, batch_size=1000):
         assert self.driver, "Driver not initialized!"
-        with self.driver.session() as session:
-            ret = []
-            count = 0
-            for node in nodes:
-                exists = list(session.run("MATCH (node:{} {{key: \"{}\"}}) RETURN node".format(node.type, node.key)))
-                if len(exists) == 0:
-                    # print("Attempting to upload", node.title, str(node.attrs))
-                    # assert type(doc) == Document , "Error: non-Document node passed to doc upload function"
-                    ret.append(session.write_transaction(self._create_and_return_node, node.to_dict()))
-                    print("Uploaded", node.key)
-                    count += 1
-                else:
-                    print(node.key, "already exists in database")
-            print("Uploaded {} nodes out of {} total".format(count, len(nodes)))
-            return ret
+        if diff:
+            return self.upload_nodes_diff(nodes, batch_size=batch_size)
+        try:
+            with self._session() as session:
+                ret = []
+                count = 0
+                for node in nodes:
+                    query = "MATCH (node:{} {{key: \"{}\"}}) RETURN node".format(node.type, node.key)
+                    exists = self._with_retries(lambda: list(session.run(query)), query)
+                    if len(exists) == 0:
+                        # print("Attempting to upload", node.title, str(node.attrs))
+                        # assert type(doc) == Document , "Error: non-Document node passed to doc upload function"
+                        ret.append(session.write_transaction(self._create_and_return_node, node.to_dict()))
+                        print("Uploaded", node.key)
+                        count += 1
+                    else:
+                        print(node.key, "already exists in database")
+                print("Uploaded {} nodes out of {} total".format(count, len(nodes)))
+        finally:
+            self._bump_epoch()
+        return ret
+
+    # Diff-before-write upload: reads the stored properties of each batch's keys in one query, then
+    # creates missing nodes and SETs only the changed properties of existing ones, in batched writes.
+    # A content_hash property stored with each node lets unchanged nodes skip the property comparison.
+    # New nodes get raw_count and parent_doc from the model; existing nodes keep their stored ones.
+    # Returns {'created': count, 'updated': count, 'unchanged': count}
+    def upload_nodes_diff(self, nodes, batch_size=1000):
+        assert self.driver, "Driver not initialized!"
+        counts = {'created': 0, 'updated': 0, 'unchanged': 0}
+        try:
+            with self._session() as session:
+                for node_type, typed_nodes in group_by(dedupe_nodes(nodes), lambda node: node.type).items():
+                    read = "UNWIND $keys AS k MATCH (node:{} {{key: k}}) RETURN node.key AS key, properties(node) AS props".format(node_type)
+                    create = "UNWIND $rows AS row CREATE (node:{}) SET node = row, node.{} = timestamp()".format(node_type, INGESTED_AT)
+                    update = "UNWIND $rows AS row MATCH (node:{} {{key: row.key}}) SET node += row.props, node.{} = timestamp()".format(node_type, INGESTED_AT)
+                    for batch in batches(typed_nodes, batch_size):
+                        stored = {record['key']: record['props'] for record in session.read_transaction(self._run_records, read, {'keys': [node.key for node in batch]})}
+                        creates, updates = [], []
+                        rehashed = 0
+                        for node in batch:
+                            properties = self._strip_nulls(node.to_dict())
+                            properties['content_hash'] = content_hash(properties)
+                            if node.key not in stored:
+                                creates.append(properties)
+                            else:
+                                changed = diff_properties(stored[node.key], properties)
+                                if changed:
+                                    updates.append({'key': node.key, 'props': changed})
+                                # Only the stored hash was stale or missing, write it so the next diff takes the fast path
+                                if list(changed.keys()) == ['content_hash']:
+                                    rehashed += 1
+                        if creates:
+                            session.write_transaction(self._run_batch, create, creates)
+                        if updates:
+                            session.write_transaction(self._run_batch, update, updates)
+                        counts['created'] += len(creates)
+                        counts['updated'] += len(updates) - rehashed
+                        counts['unchanged'] += len(batch) - len(creates) - len(updates) + rehashed
+            print("Diff upload: {} created, {} updated, {} unchanged".format(counts['created'], counts['updated'], counts['unchanged']))
+        finally:
+            self._bump_epoch()
+        return counts
+
+    @staticmethod
+    def _run_records(tx, query, params):
+        return list(tx.run(query, params))
 
     @staticmethod
     def _create_and_return_node(tx, node_dict):
         cypherquery = ["CREATE (node:{})".format(node_dict['type'])]
         for key in node_dict.keys():
             cypherquery.append("SET node.{} = ${}".format(key, key))
+        cypherquery.append("SET node.{} = timestamp()".format(INGESTED_AT))
         cypherquery.append("RETURN node")
 #         print(" ".join(cypherquery))
         result = tx.run(" ".join(cypherquery), node_dict)
@@ -160,26 +487,31 @@ class GraphDBDriver:
     # Edges Methods
     def upload_edges(self, edges):
         assert self.driver, "Driver not initialized!"
-        with self.driver.session() as session:
-            ret = []
-            count = 0
-            for edge in edges:
-                exists = list(session.run("MATCH (a:{} {{key: \"{}\"}})-[edge:{}]->(b:{} {{key: \"{}\"}}) RETURN edge".format(edge.source_type, edge.source_key, edge.label, edge.dest_type, edge.dest_key)))
-                if len(exists) == 0:
-                    # assert type(doc) == Document , "Error: non-Document node passed to doc upload function"
-                    ret.append(session.write_transaction(self._create_and_return_edge, edge.to_dict(), edge.source_key, edge.dest_key))
-                    print("Uploaded", str(edge))
-                    count += 1
-                else:
-                    print(str(edge), "already exists in database")
-            print("Uploaded {} edges out of {} total".format(count, len(edges)))
-            return ret
+        try:
+            with self._session() as session:
+                ret = []
+                count = 0
+                for edge in edges:
+                    query = "MATCH (a:{} {{key: \"{}\"}})-[edge:{}]->(b:{} {{key: \"{}\"}}) RETURN edge".format(edge.source_type, edge.source_key, edge.label, edge.dest_type, edge.dest_key)
+                    exists = self._with_retries(lambda: list(session.run(query)), query)
+                    if len(exists) == 0:
+                        # assert type(doc) == Document , "Error: non-Document node passed to doc upload function"
+                        ret.append(session.write_transaction(self._create_and_return_edge, edge.to_dict(), edge.source_key, edge.dest_key))
+                        print("Uploaded", str(edge))
+                        count += 1
+                    else:
+                        print(str(edge), "already exists in database")
+                print("Uploaded {} edges out of {} total".format(count, len(edges)))
+        finally:
+            self._bump_epoch()
+        return ret
 
     @staticmethod
     def _create_and_return_edge(tx, edge_dict, source_key, dest_key):
         cypherquery = ["MATCH (a), (b)", "WHERE a.key=\"{}\" AND b.key = \"{}\"".format(source_key, dest_key), "CREATE (a)-[edge:{}]->(b)".format(edge_dict['label'])]
         for key in edge_dict.keys():
             cypherquery.append("SET edge.{} = ${}".format(key, key))
+        cypherquery.append("SET edge.{} = timestamp()".format(INGESTED_AT))
         cypherquery.append("RETURN edge")
 #         print(" ".join(cypherquery))
         result = tx.run(" ".join(cypherquery), edge_dict)
@@ -187,6 +519,262 @@ class GraphDBDriver:
         entry = result.single()        
         return entry['edge'] if entry else None
 
+    # Merge Methods
+    # Upserts nodes by key in batched UNWIND queries, one transaction per batch and node type
+    # Nodes that already exist only have their raw_count increased
+    def merge_nodes(self, nodes, batch_size=1000):
+        assert self.driver, "Driver not initialized!"
+        nodes = dedupe_nodes(nodes)
+        count = 0
+        try:
+            with self._session() as session:
+                for node_type, typed_nodes in group_by(nodes, lambda node: node.type).items():
+                    query = "\n".join([
+                        "UNWIND $rows AS row",
+                        "MERGE (node:{} {{key: row.key}})".format(node_type),
+                        "ON CREATE SET node += row",
+                        "ON MATCH SET node.raw_count = coalesce(node.raw_count, 0) + row.raw_count, node.content_hash = null",
+                        "SET node.{} = timestamp()".format(INGESTED_AT),
+                    ])
+                    for batch in batches(typed_nodes, batch_size):
+                        rows = [self._strip_nulls(node.to_dict()) for node in batch]
+                        count += session.write_transaction(self._run_batch, query, rows).nodes_created
+            print("Merged {} nodes ({} new)".format(len(nodes), count))
+        finally:
+            self._bump_epoch()
+        return count
+
+    # Upserts edges between nodes matched by type and key. Edges whose endpoints are missing are skipped
+    def merge_edges(self, edges, batch_size=1000):
+        assert self.driver, "Driver not initialized!"
+        edges = dedupe_edges(edges)
+        count = 0
+        try:
+            with self._session() as session:
+                groups = group_by(edges, lambda edge: (edge.source_type, edge.label, edge.dest_type))
+                for (source_type, label, dest_type), typed_edges in groups.items():
+                    query = "\n".join([
+                        "UNWIND $rows AS row",
+                        "MATCH (a:{} {{key: row.source_key}}), (b:{} {{key: row.dest_key}})".format(source_type, dest_type),
+                        "MERGE (a)-[edge:{}]->(b)".format(label),
+                        "ON CREATE SET edge += row",
+                        "ON MATCH SET edge.raw_count = coalesce(edge.raw_count, 0) + row.raw_count",
+                        "SET edge.{} = timestamp()".format(INGESTED_AT),
+                    ])
+                    for batch in batches(typed_edges, batch_size):
+                        rows = [self._strip_nulls(edge.to_dict()) for edge in batch]
+                        count += session.write_transaction(self._run_batch, query, rows).relationships_created
+            print("Merged {} edges ({} new)".format(len(edges), count))
+        finally:
+            self._bump_epoch()
+        return count
+
+    # Unique key constraints make MERGE safe under concurrent writers and back key lookups with an index
+    def create_key_constraints(self, node_types):
+        for node_type in node_types:
+            self.raw_query("CREATE CONSTRAINT unique_key_{} IF NOT EXISTS ON (n:{}) ASSERT n.key IS UNIQUE".format(node_type, node_type))
+
+    # Parent_doc indexes keep document retraction from scanning every node per batch
+    def create_parent_doc_indexes(self, node_types):
+        for node_type in node_types:
+            self.raw_query("CREATE INDEX parent_doc_{} IF NOT EXISTS FOR (n:{}) ON (n.parent_doc)".format(node_type, node_type))
+
+    # Delete Methods
+    # Deletes run in batches of at most batch_size items, each batch in its own transaction.
+    # Relationships are deleted before their nodes so a hub never needs one huge DETACH DELETE.
+    # Each method returns {'nodes': count, 'edges': count} and invalidates the query cache.
+    # keys are node keys of node_type, or (key, type) pairs when node_type is None. Matching by
+    # label lets every batch use the key index instead of scanning all nodes
+    def delete_nodes(self, keys, node_type=None, batch_size=1000):
+        assert self.driver, "Driver not initialized!"
+        if node_type:
+            typed_keys = {node_type: list(keys)}
+        else:
+            pairs = list(keys)
+            assert all(type(pair) == tuple and len(pair) == 2 for pair in pairs), "Error: pass node_type or (key, type) pairs"
+            typed_keys = {typed: [key for key, _ in group] for typed, group in group_by(pairs, lambda pair: pair[1]).items()}
+        counts = {'nodes': 0, 'edges': 0}
+        total = sum(len(type_keys) for type_keys in typed_keys.values())
+        try:
+            with self._session() as session:
+                processed = 0
+                for typed, type_keys in typed_keys.items():
+                    match = "MATCH (node:{} {{key: k}})".format(typed)
+                    for batch in batches(type_keys, batch_size):
+                        counts['edges'] += self._delete_in_batches(session, "\n".join([
+                            "UNWIND $keys AS k", match,
+                            "MATCH (node)-[edge]-()",
+                            "WITH DISTINCT edge LIMIT $batch_size",
+                            "DELETE edge RETURN count(edge) AS count",
+                        ]), {'keys': batch}, batch_size, "edges")
+                        counts['nodes'] += session.write_transaction(self._run_count, "\n".join([
+                            "UNWIND $keys AS k", match,
+                            "DELETE node RETURN count(node) AS count",
+                        ]), {'keys': batch})
+                        processed += len(batch)
+                        print("Deleted {} nodes ({} of {} keys processed)".format(counts['nodes'], processed, total))
+        finally:
+            self._bump_epoch()
+        return counts
+
+    # Retracts a document: its interactions and attributes, their edges, and its entities unless
+    # they are still connected to another document (entity keys are shared across documents)
+    # A shared entity keeps the parent_doc of the document that created it, so entities whose last
+    # edges this retraction removes are deleted by key, whatever their parent_doc
+    def delete_by_parent_doc(self, parent_doc, node_types=None, batch_size=1000):
+        assert self.driver, "Driver not initialized!"
+        node_types = node_types if node_types is not None else list(NODE_MODELS.keys())
+        counts = {'nodes': 0, 'edges': 0}
+        touched = set() # keys of entities that lost edges in this retraction
+        try:
+            with self._session() as session:
+                for node_type in node_types:
+                    counts['edges'] += self._delete_in_batches(session, "\n".join([
+                        "MATCH (node:{} {{parent_doc: $doc}})-[edge]-(other)".format(node_type),
+                        "WHERE node.type <> 'entity' OR other.parent_doc = $doc",
+                        "WITH DISTINCT edge LIMIT $batch_size",
+                        "WITH edge, [n IN [startNode(edge), endNode(edge)] WHERE n.type = 'entity' | n.key] AS entities",
+                        "DELETE edge RETURN count(edge) AS count, collect(entities) AS entities",
+                    ]), {'doc': parent_doc}, batch_size, node_type + " edges", touched=touched)
+                for node_type in node_types:
+                    counts['nodes'] += self._delete_in_batches(session, "\n".join([
+                        "MATCH (node:{} {{parent_doc: $doc}})".format(node_type),
+                        "WHERE NOT (node)--()",
+                        "WITH node LIMIT $batch_size",
+                        "DELETE node RETURN count(node) AS count",
+                    ]), {'doc': parent_doc}, batch_size, node_type + " nodes")
+                if 'entity' in node_types:
+                    for batch in batches(sorted(touched), batch_size):
+                        counts['nodes'] += session.write_transaction(self._run_count, "\n".join([
+                            "UNWIND $keys AS k",
+                            "MATCH (node:entity {key: k})",
+                            "WHERE NOT (node)--()",
+                            "DELETE node RETURN count(node) AS count",
+                        ]), {'keys': batch})
+        finally:
+            self._bump_epoch()
+        print("Retracted {}: deleted {} nodes and {} edges".format(parent_doc, counts['nodes'], counts['edges']))
+        return counts
+
+    # Deletes the given Edge models, or every edge with the given label
+    def delete_edges(self, edges=None, label=None, batch_size=1000):
+        assert self.driver, "Driver not initialized!"
+        assert edges is not None or label, "Error: pass edges or a label to delete"
+        counts = {'nodes': 0, 'edges': 0}
+        try:
+            with self._session() as session:
+                if edges is None:
+                    counts['edges'] += self._delete_in_batches(session, "\n".join([
+                        "MATCH ()-[edge:{}]->()".format(label),
+                        "WITH edge LIMIT $batch_size",
+                        "DELETE edge RETURN count(edge) AS count",
+                    ]), dict(), batch_size, label + " edges")
+                else:
+                    groups = group_by(edges, lambda edge: (edge.source_type, edge.label, edge.dest_type))
+                    for (source_type, edge_label, dest_type), typed_edges in groups.items():
+                        query = "\n".join([
+                            "UNWIND $rows AS row",
+                            "MATCH (a:{} {{key: row.source_key}})-[edge:{}]->(b:{} {{key: row.dest_key}})".format(source_type, edge_label, dest_type),
+                            "DELETE edge RETURN count(edge) AS count",
+                        ])
+                        for batch in batches(typed_edges, batch_size):
+                            rows = [{'source_key': edge.source_key, 'dest_key': edge.dest_key} for edge in batch]
+                            counts['edges'] += session.write_transaction(self._run_count, query, {'rows': rows})
+                            print("Deleted {} edges".format(counts['edges']))
+        finally:
+            self._bump_epoch()
+        return counts
+
+    # Reruns a "... LIMIT $batch_size DELETE ... RETURN count" query until a batch comes back short
+    # If the query also returns entities (a list of key lists), they are added to touched
+    def _delete_in_batches(self, session, query, params, batch_size, what, touched=None):
+        params = dict(params, batch_size=batch_size)
+        total = 0
+        while True:
+            count, entities = session.write_transaction(self._run_delete, query, params)
+            total += count
+            if touched is not None:
+                for keys in entities:
+                    touched.update(keys)
+            if count > 0:
+                print("Deleted {} {}".format(total, what))
+            if count < batch_size:
+                return total
+
+    @staticmethod
+    def _run_count(tx, query, params):
+        entry = tx.run(query, params).single()
+        return entry['count'] if entry else 0
+
+    @staticmethod
+    def _run_delete(tx, query, params):
+        entry = tx.run(query, params).single()
+        return (entry['count'], entry.get('entities') or []) if entry else (0, [])
+
+    # Connection Methods
+    # Opens a session, counting how many are open at once to compare against the pool size
+    @contextmanager
+    def _session(self, **session_config):
+        with self._stats_lock:
+            self.stats['sessions'] += 1
+            self.stats['in_flight'] += 1
+            self.stats['max_in_flight'] = max(self.stats['max_in_flight'], self.stats['in_flight'])
+        try:
+            with self.driver.session(**session_config) as session:
+                yield session
+        except Exception as e:
+            if is_acquisition_timeout(e):
+                self._count('acquisition_timeouts')
+            raise
+        finally:
+            with self._stats_lock:
+                self.stats['in_flight'] -= 1
+
+    # Runs fn, retrying transient errors with exponential backoff (with jitter) up to max_retries times
+    # With retry=False (write queries) the first error is raised, since the write may have committed
+    def _with_retries(self, fn, query, retry=True):
+        self._count('queries')
+        attempt = 0
+        while True:
+            try:
+                return fn()
+            except (Neo4jError, DriverError) as e:
+                if not retry or not is_transient(e) or attempt >= self.max_retries:
+                    self._count('failures')
+                    message = "Query failed after {} retries: {}".format(attempt, e) if attempt else "Query failed: {}".format(e)
+                    raise QueryError(message, query=query, retries=attempt) from e
+                delay = min(self.max_retry_delay, self.retry_delay * 2 ** attempt) * random.uniform(0.5, 1)
+                attempt += 1
+                self._count('retries')
+                print("Transient error, retrying in {:.2f}s ({} of {}): {}".format(delay, attempt, self.max_retries, e))
+                time.sleep(delay)
+
+    def _count(self, name, amount=1):
+        with self._stats_lock:
+            self.stats[name] += amount
+
+    # Session and retry counters since the driver was created. saturation is the peak number of
+    # concurrent sessions over the pool size: near 1.0, callers were queueing for connections
+    def pool_stats(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats['pool_size'] = self.pool_size
+        stats['saturation'] = stats['max_in_flight'] / self.pool_size if self.pool_size else 0
+        return stats
+
+    # Invalidates cached query results after a write
+    def _bump_epoch(self):
+        if self.cache is not None:
+            self.cache.bump_epoch()
+
+    @staticmethod
+    def _run_batch(tx, query, rows):
+        return tx.run(query, rows=rows).consume().counters
+
+    @staticmethod
+    def _strip_nulls(properties):
+        return {key: value for key, value in properties.items() if value is not None}
+
     # Helper Methods   
     """
     Converts a node in dictionary form to a cypher create query
@@ -211,22 +799,16 @@ class GraphDBDriver:
         assert 'node' in record.keys() or 'edge' in record.keys(), "Neither node or edge found in record keys: " + str(record.keys())
         ret = dict()
         def node_to_model(node):
-            # print(node.id)
-            # print(node.keys())
-            if node['type'] == 'entity':
-                return Entity(node['key'], attrs=dict(node))
-            elif node['type'] == 'action':
-                return Action(node['key'], attrs=dict(node))
-            elif node['type'] == 'source':
-                return Source(node['key'], node['name'], node['source_type'], attrs=dict(node), date_processed=node['date_processed'], db_id=node.id)
-            elif node['type'] == 'document':
-                return Document(node['key'], node['title'], node['doc_type'], attrs=dict(node), date_processed=node['date_processed'], db_id=node.id)
+            if node['type'] in NODE_MODELS:
+                model = NODE_MODELS[node['type']](node['key'], node.get('title'), node.get('parent_doc'), attrs=dict(node), db_id=node.id)
+                model.raw_count = node.get('raw_count', 1)
+                return model
             else:
                 print("ERROR: unrecognized node type:", node['type'])
 
         # Process Node
         if 'node' in record.keys():
-            assert record['node']['type'] in ['entity', 'action', 'source', 'document'], "Error: unidentified node type " + record['node']['type']
+            assert record['node']['type'] in NODE_MODELS, "Error: unidentified node type " + record['node']['type']
             node = node_to_model(record['node'])
             if node:
                 ret['node'] = node
@@ -234,7 +816,6 @@ class GraphDBDriver:
         # TODO: This part can probably be greatly optimized since I am building two new node objects for every edge
         # Process Edge
         if 'edge' in record.keys():
-            assert record['edge']['label'] in ['contains', 'authored', 'interacts', 'references', 'involved'], "Error: unidentified edge type " + record['edge']['label']
             edge = record['edge']
             # source, dest = node_to_model(edge.nodes[0]), node_to_model(edge.nodes[1])
             # if edge['label'] == 'contains':
@@ -251,6 +832,86 @@ class GraphDBDriver:
         
         return ret
 
+# Traversal Helpers
+TRAVERSAL_PATTERNS = {
+    'out': "(n)-[edge]->(m)",
+    'in': "(n)<-[edge]-(m)",
+    'both': "(n)-[edge]-(m)",
+}
+
+# Returns the (key, type) tuple of a Node model or tuple
+def node_key_type(node):
+    if type(node) == tuple:
+        return node
+    return node.key, node.type
+
+# Edge tuple in the same (label, source_key, dest_key) order as Edge.tup()
+def edge_tuple(key, neighbor_key, label, outgoing):
+    return (label, key, neighbor_key) if outgoing else (label, neighbor_key, key)
+
+# Joins the two halves of a bidirectional search at the node where they met
+def join_paths(meeting, forward, backward):
+    nodes, edges = [meeting], []
+    node = meeting
+    while forward[node]:
+        node, edge = forward[node]
+        nodes.insert(0, node)
+        edges.insert(0, edge)
+    node = meeting
+    while backward[node]:
+        node, edge = backward[node]
+        nodes.append(node)
+        edges.append(edge)
+    return {'nodes': nodes, 'edges': edges}
+
+# Error Helpers
+def is_transient(error):
+    # Newer drivers know which transient errors (e.g. terminated transactions) must not be retried
+    if isinstance(error, TransientError) and hasattr(error, 'is_retriable'):
+        return error.is_retriable()
+    return isinstance(error, RETRYABLE_ERRORS)
+
+# The pool raises a ClientError when no connection frees up within connection_acquisition_timeout
+def is_acquisition_timeout(error):
+    return "obtain a connection from pool" in str(error)
+
+# Helper Functions
+# Splits an iterable into lists of at most size items
+def batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+# Returns the properties (including content_hash) that differ between a stored node and a model's
+# properties, with removed properties set to None. Returns an empty dict if the hashes match
+# MERGE_MANAGED_PROPERTIES are never part of the diff, so stored counts and parent_doc are kept
+def diff_properties(stored, properties):
+    if stored.get('content_hash') == properties['content_hash']:
+        return dict()
+    changed = {key: value for key, value in properties.items()
+               if key not in MERGE_MANAGED_PROPERTIES and native_value(stored.get(key)) != value}
+    for key in stored.keys():
+        if key not in properties and key not in INTERNAL_PROPERTIES and key not in MERGE_MANAGED_PROPERTIES:
+            changed[key] = None
+    return changed
+
+# Maps a value to one of n partitions, stable across processes (unlike hash())
+def stable_partition(value, n):
+    digest = hashlib.blake2b(str(value).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % n
+
+# Groups items into a dictionary of lists by key_fn, preserving order
+def group_by(items, key_fn):
+    groups = dict()
+    for item in items:
+        groups.setdefault(key_fn(item), []).append(item)
+    return groups
+
 if __name__ == "__main__":  
     # greeter = HelloWorldExample("bolt://localhost:7687", "neo4j", "neo4j")
     print("Testing Graph Driver...")
@@ -288,8 +949,8 @@ if __name__ == "__main__":
     # print([str(r) for r in nodes_by_id])
 
     print("Cleaning up")
-    driver.raw_query("MATCH (n:entity) WHERE n.key=\"entity1\" DETACH DELETE n")
-    driver.raw_query("MATCH (n:interaction) WHERE n.key=\"interacted\" DETACH DELETE n")
+    driver.delete_nodes(["entity1"], node_type="entity")
+    driver.delete_nodes(["interacted"], node_type="interaction")
     print("Deleted nodes")
     driver.close()
     print("Finished")
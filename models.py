@@ -1,4 +1,4 @@
-import datetime
+import copy, datetime, hashlib, json
 import neo4j
 
 primitives = set([int, float, bool, datetime.datetime, str, list, neo4j.time.DateTime]) # Neo4j can only take primitive types or arrays
@@ -136,3 +136,89 @@ def flatten_json(y):
 
     flatten(y)
     return out
+
+"""
+Content-addressed keys
+A node's key is a stable hash of its normalized title, its type and an optional scope (e.g. parent_doc),
+so the same entity from two documents gets the same key without asking the database.
+Unscoped keys are shared across documents, scoped keys are only shared within their scope.
+"""
+KEY_DIGEST_SIZE = 16 # bytes, keys are hex strings of twice this length
+
+# Casefolds and collapses whitespace so surface variants of a title share a key
+def normalize_title(title):
+    return " ".join(str(title).split()).casefold()
+
+def content_key(title, node_type, scope=None):
+    parts = [node_type, normalize_title(title)]
+    if scope is not None:
+        parts.append(str(scope))
+    payload = "\x1f".join(parts).encode("utf-8")
+    return hashlib.blake2b(payload, digest_size=KEY_DIGEST_SIZE).hexdigest()
+
+# Maps surface forms (e.g. "Uber Technologies", "UBER") to the canonical key of a node
+class AliasTable:
+    def __init__(self, aliases=dict()):
+        self.aliases = dict() # (node_type, normalized surface form) -> canonical key
+        for (node_type, surface), key in aliases.items():
+            self.add_key(surface, key, node_type)
+
+    def __len__(self):
+        return len(self.aliases)
+
+    # Points a surface form at the canonical key of another title
+    def add(self, surface, canonical_title, node_type, scope=None):
+        self.add_key(surface, content_key(canonical_title, node_type, scope=scope), node_type)
+
+    def add_key(self, surface, key, node_type):
+        assert type(key) == str, "Error: key must be a string"
+        self.aliases[node_type, normalize_title(surface)] = key
+
+    # Returns the canonical key for a title, falling back to its content key
+    def key_for(self, title, node_type, scope=None):
+        key = self.aliases.get((node_type, normalize_title(title)))
+        return key if key else content_key(title, node_type, scope=scope)
+
+    def to_dict(self):
+        return dict(self.aliases)
+
+# Properties written by the driver itself rather than coming from a model's to_dict()
+INTERNAL_PROPERTIES = set(['db_id', 'ingested_at', 'content_hash', 'ghost', 'home_shards'])
+
+# Properties that merge_nodes accumulates (raw_count) or keeps from the first document (parent_doc) for shared nodes
+# Re-uploading a node from another document must not overwrite them, so they are left out of diffs and content hashes
+MERGE_MANAGED_PROPERTIES = set(['raw_count', 'parent_doc'])
+
+# Converts neo4j temporal values to native ones so stored and model properties compare equal
+def native_value(value):
+    return value.to_native() if hasattr(value, 'to_native') else value
+
+# Stable hash of a node's properties (as returned by to_dict or read back from the database)
+# Used to skip unchanged nodes when re-uploading without comparing every property
+def content_hash(properties):
+    content = {key: native_value(value) for key, value in properties.items()
+               if key not in INTERNAL_PROPERTIES and key not in MERGE_MANAGED_PROPERTIES and value is not None}
+    payload = json.dumps(content, sort_keys=True, default=str, separators=(',', ':')).encode("utf-8")
+    return hashlib.blake2b(payload, digest_size=KEY_DIGEST_SIZE).hexdigest()
+
+# Client-side dedup of a batch, repeated keys are folded into the raw_count of a copy of the first occurrence
+# The passed-in models are never modified, so deduping the same list again (e.g. a retry) gives the same counts
+def dedupe_nodes(nodes):
+    return _dedupe(nodes, lambda node: node.key)
+
+def dedupe_edges(edges):
+    return _dedupe(edges, lambda edge: edge.tup())
+
+def _dedupe(models, key_fn):
+    unique = dict()
+    folded = set() # keys whose entry is already a copy
+    for model in models:
+        key = key_fn(model)
+        if key not in unique:
+            unique[key] = model
+            continue
+        if key not in folded:
+            unique[key] = copy.copy(unique[key])
+            folded.add(key)
+        unique[key].raw_count += model.raw_count
+    return list(unique.values())
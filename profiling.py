@@ -0,0 +1,140 @@
+import json, os, sys, time, tracemalloc, types
+from contextlib import contextmanager
+
+"""
+Memory and allocation profiling
+
+Footprint reports for collections of Node/Edge models and for StoryGraph, plus tracemalloc
+snapshots around any call (e.g. GraphDBDriver.record_to_models or upload_*). Every report is
+a plain dictionary of numbers and strings, so it can be written as JSON and compared in CI.
+
+    report = profile_models(nodes)
+    result, report = profile_call(driver.upload_nodes, nodes, label="upload_nodes")
+    write_report(report, "output/upload_profile.json")
+
+Sizes come from sys.getsizeof and count each object once per report, so strings and values
+shared between models are only attributed to the first model that references them.
+"""
+DEFAULT_TOP = 10
+# Shared code objects that deep_sizeof never descends into
+SKIPPED_TYPES = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType)
+
+# Recursive size of an object and everything it references, skipping ids already in seen
+def deep_sizeof(obj, seen=None):
+    seen = seen if seen is not None else set()
+    stack = [obj]
+    size = 0
+    while stack:
+        current = stack.pop()
+        if id(current) in seen or isinstance(current, SKIPPED_TYPES):
+            continue
+        seen.add(id(current))
+        size += sys.getsizeof(current)
+        if isinstance(current, dict):
+            stack.extend(current.keys())
+            stack.extend(current.values())
+        elif isinstance(current, (list, tuple, set, frozenset)):
+            stack.extend(current)
+        elif not isinstance(current, (str, bytes, int, float, bool, type(None))):
+            if hasattr(current, '__dict__'):
+                stack.append(current.__dict__)
+            for slot in getattr(type(current), '__slots__', ()):
+                if hasattr(current, slot):
+                    stack.append(getattr(current, slot))
+    return size
+
+# Footprint of one model split into its attrs payload and everything else
+def model_footprint(model, seen=None):
+    seen = seen if seen is not None else set()
+    attrs = getattr(model, 'attrs', None)
+    attrs_bytes = deep_sizeof(attrs, seen) if attrs is not None else 0
+    total = attrs_bytes + deep_sizeof(model, seen)
+    return {'total_bytes': total, 'attrs_bytes': attrs_bytes, 'attr_count': len(attrs) if attrs else 0}
+
+# Memory footprint of a collection of Node/Edge models, broken down by model class and node type/edge label
+def profile_models(models, seen=None):
+    seen = seen if seen is not None else set()
+    report = {'count': 0, 'total_bytes': 0, 'attrs_bytes': 0, 'by_class': dict(), 'by_type': dict()}
+    for model in models:
+        footprint = model_footprint(model, seen)
+        kind = getattr(model, 'type', None) or getattr(model, 'label', None) or 'unknown'
+        for group, name in [('by_class', type(model).__name__), ('by_type', kind)]:
+            entry = report[group].setdefault(name, {'count': 0, 'total_bytes': 0, 'attrs_bytes': 0, 'attr_count': 0})
+            entry['count'] += 1
+            entry['total_bytes'] += footprint['total_bytes']
+            entry['attrs_bytes'] += footprint['attrs_bytes']
+            entry['attr_count'] += footprint['attr_count']
+        report['count'] += 1
+        report['total_bytes'] += footprint['total_bytes']
+        report['attrs_bytes'] += footprint['attrs_bytes']
+    for group in ['by_class', 'by_type']:
+        for entry in report[group].values():
+            entry['avg_bytes'] = entry['total_bytes'] / entry['count']
+    return report
+
+# Footprint of a StoryGraph: the node/edge models plus each container attribute's own overhead
+def profile_storygraph(graph):
+    seen = set()
+    report = {'title': graph.title, 'nodes': profile_models(graph.nodes, seen), 'edges': profile_models(graph.edges, seen), 'containers': dict()}
+    # Models are already in seen, so containers only count their own structure and keys
+    for name in ['node_dict', 'key_to_node', 'custom_keys', 'nodes', 'edges', 'edge_dict', 'nodes_by_type', 'edges_by_label', 'out_edges', 'in_edges',
+                 'change_log', 'token_to_idx', 'pending_edges', 'rendered_edges', 'nx_dirty']:
+        if hasattr(graph, name):
+            report['containers'][name] = {'count': len(getattr(graph, name)), 'bytes': deep_sizeof(getattr(graph, name), seen)}
+    display_graph = getattr(graph, 'display_graph', None)
+    report['containers']['display_graph'] = {'bytes': deep_sizeof(display_graph, seen) if display_graph is not None else 0}
+    report['total_bytes'] = report['nodes']['total_bytes'] + report['edges']['total_bytes'] + sum(container['bytes'] for container in report['containers'].values())
+    return report
+
+# Allocation Snapshots
+"""
+Context manager that traces allocations made inside the block
+The yielded dictionary is filled in when the block exits:
+    seconds, allocated_bytes (net growth), peak_bytes, allocation_count and the top allocating lines
+"""
+@contextmanager
+def allocation_snapshot(label=None, top=DEFAULT_TOP):
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    report = {'label': label}
+    before = tracemalloc.take_snapshot()
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    base, _ = tracemalloc.get_traced_memory()
+    start = time.perf_counter()
+    try:
+        yield report
+    finally:
+        report['seconds'] = time.perf_counter() - start
+        current, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+        if started:
+            tracemalloc.stop()
+        filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+        stats = after.filter_traces(filters).compare_to(before.filter_traces(filters), 'lineno')
+        report['allocated_bytes'] = current - base
+        report['peak_bytes'] = peak - base
+        report['allocation_count'] = sum(stat.count_diff for stat in stats if stat.count_diff > 0)
+        report['top'] = [{
+            'file': stat.traceback[0].filename,
+            'line': stat.traceback[0].lineno,
+            'size_bytes': stat.size_diff,
+            'count': stat.count_diff,
+        } for stat in stats[:top]]
+
+# Calls fn under allocation_snapshot, returns (result, report)
+def profile_call(fn, *args, label=None, top=DEFAULT_TOP, **kwargs):
+    with allocation_snapshot(label or getattr(fn, '__name__', str(fn)), top=top) as report:
+        result = fn(*args, **kwargs)
+    return result, report
+
+# Profiles a driver method by name, e.g. profile_driver_call(driver, "upload_nodes", nodes)
+def profile_driver_call(driver, method, *args, top=DEFAULT_TOP, **kwargs):
+    return profile_call(getattr(driver, method), *args, label=type(driver).__name__ + "." + method, top=top, **kwargs)
+
+def write_report(report, path):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
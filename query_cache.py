@@ -0,0 +1,236 @@
+import hashlib, json, os, pickle, re, sqlite3, threading, time
+
+from neo4j.data import Record
+from neo4j.graph import Node as GraphNode, Relationship as GraphRelationship, Path as GraphPath
+from neo4j.time import Date, Time, DateTime, Duration
+
+"""
+Persistent query result cache
+
+Opt-in cache for analytical reads made through GraphDBDriver.raw_query/structured_query.
+Entries are keyed by the normalized query text, its parameters and a namespace (the driver
+passes its URI, so local and remote graphs can share one file) and stored in a local SQLite
+file, so repeated queries are served across process restarts.
+
+Every entry is tagged with the graph "epoch" current when its query started. Upload and other write methods
+on the driver bump the epoch, which invalidates every older entry at once. Entries also
+expire after a TTL, and the least recently used entries are evicted once the file grows
+past max_bytes.
+
+    cache = QueryCache("output/query_cache.sqlite", ttl=24 * 3600)
+    driver = GraphDBDriver(cache=cache)
+    driver.structured_query(MATCH="(node:document)", RETURN="node", use_cache=True)
+"""
+DEFAULT_CACHE_PATH = "output/query_cache.sqlite"
+DEFAULT_TTL = 24 * 3600 # seconds
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+# Splits out quoted string literals so whitespace inside them is preserved
+STRING_LITERAL = re.compile(r"""("(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')""")
+WHITESPACE = re.compile(r"\s+")
+WRITE_CLAUSE = re.compile(r"\b(CREATE|MERGE|SET|DELETE|REMOVE|DROP|LOAD\s+CSV)\b", re.IGNORECASE)
+
+# Collapses whitespace outside of string literals so formatting differences share a cache entry
+def normalize_query(query):
+    parts = STRING_LITERAL.split(query.strip())
+    for i in range(0, len(parts), 2):
+        parts[i] = WHITESPACE.sub(" ", parts[i])
+    return "".join(parts)
+
+def is_write_query(query):
+    return WRITE_CLAUSE.search(STRING_LITERAL.sub("''", query)) is not None
+
+def cache_key(query, params=None, namespace=None):
+    payload = (namespace or "") + "\0" + normalize_query(query) + "\0" + json.dumps(params or dict(), sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+# Stand-ins for neo4j graph objects, which hold a reference to their result and can't be pickled
+# They keep the parts the driver relies on: dict-style property access, .id and labels/type
+class CachedNode(dict):
+    def __init__(self, properties, id=None, labels=()):
+        super().__init__(properties)
+        self.id = id
+        self.labels = frozenset(labels)
+
+class CachedRelationship(dict):
+    def __init__(self, properties, id=None, type=None, start_node=None, end_node=None):
+        super().__init__(properties)
+        self.id = id
+        self.type = type
+        self.start_node = start_node
+        self.end_node = end_node
+
+    @property
+    def nodes(self):
+        return self.start_node, self.end_node
+
+class CachedPath:
+    def __init__(self, nodes, relationships):
+        self.nodes = tuple(nodes)
+        self.relationships = tuple(relationships)
+
+    @property
+    def start_node(self):
+        return self.nodes[0]
+
+    @property
+    def end_node(self):
+        return self.nodes[-1]
+
+# neo4j temporal values can't be unpickled, so they are stored as ISO strings (which keep nanoseconds)
+# plus the name of their timezone, if any, and rebuilt when the entry is read
+class CachedTemporal:
+    TYPES = {'Date': Date, 'Time': Time, 'DateTime': DateTime}
+
+    def __init__(self, value):
+        self.kind = type(value).__name__
+        self.iso = value.iso_format()
+        self.zone = getattr(value.tzinfo, 'zone', None) if self.kind != 'Date' else None
+
+    def thaw(self):
+        value = self.TYPES[self.kind].from_iso_format(self.iso)
+        if self.zone and self.kind == 'DateTime':
+            import pytz
+            value = value.astimezone(pytz.timezone(self.zone))
+        return value
+
+# Duration is a (months, days, seconds, subseconds) tuple whose constructor takes keywords
+class CachedDuration:
+    def __init__(self, value):
+        self.months, self.days, self.seconds, self.subseconds = tuple(value)
+
+    def thaw(self):
+        return Duration(months=self.months, days=self.days, seconds=self.seconds, subseconds=self.subseconds)
+
+def freeze_properties(properties):
+    return {key: freeze_value(item) for key, item in properties.items()}
+
+def freeze_value(value):
+    if isinstance(value, GraphNode):
+        return CachedNode(freeze_properties(value), id=value.id, labels=value.labels)
+    elif isinstance(value, GraphRelationship):
+        return CachedRelationship(freeze_properties(value), id=value.id, type=value.type,
+            start_node=freeze_value(value.start_node), end_node=freeze_value(value.end_node))
+    elif isinstance(value, GraphPath):
+        return CachedPath([freeze_value(node) for node in value.nodes], [freeze_value(rel) for rel in value.relationships])
+    elif type(value) is list:
+        return [freeze_value(item) for item in value]
+    elif type(value) is dict:
+        return freeze_properties(value)
+    elif isinstance(value, (Date, Time, DateTime)):
+        return CachedTemporal(value)
+    elif isinstance(value, Duration):
+        return CachedDuration(value)
+    return value
+
+# Rebuilds the temporal values inside a frozen value
+def thaw_value(value):
+    if isinstance(value, (CachedTemporal, CachedDuration)):
+        return value.thaw()
+    elif isinstance(value, (CachedNode, CachedRelationship)):
+        for key, item in value.items():
+            value[key] = thaw_value(item)
+        if isinstance(value, CachedRelationship):
+            value.start_node, value.end_node = thaw_value(value.start_node), thaw_value(value.end_node)
+        return value
+    elif isinstance(value, CachedPath):
+        return CachedPath([thaw_value(node) for node in value.nodes], [thaw_value(rel) for rel in value.relationships])
+    elif type(value) is list:
+        return [thaw_value(item) for item in value]
+    elif type(value) is dict:
+        return {key: thaw_value(item) for key, item in value.items()}
+    return value
+
+# Records are stored as (keys, values) pairs and rebuilt as real Records on load
+def freeze_records(records):
+    return [(list(record.keys()), [freeze_value(value) for value in record.values()]) for record in records]
+
+def thaw_records(frozen):
+    return [Record(zip(keys, [thaw_value(value) for value in values])) for keys, values in frozen]
+
+
+class QueryCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH, ttl=DEFAULT_TTL, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL") # Lets several processes share one cache file
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY, epoch INTEGER, created REAL, accessed REAL, size INTEGER, value BLOB)""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)")
+        self._conn.execute("INSERT OR IGNORE INTO meta VALUES ('epoch', 0)")
+
+    def close(self):
+        self._conn.close()
+
+    # Epoch Methods
+    def epoch(self):
+        with self._lock:
+            return self._conn.execute("SELECT value FROM meta WHERE name = 'epoch'").fetchone()[0]
+
+    # Invalidates every entry cached before this call
+    def bump_epoch(self):
+        with self._lock:
+            self._conn.execute("UPDATE meta SET value = value + 1 WHERE name = 'epoch'")
+            self._conn.execute("DELETE FROM entries WHERE epoch < (SELECT value FROM meta WHERE name = 'epoch')")
+
+    # Entry Methods
+    # Returns the cached value, or None on a miss, an expired entry or an entry from an older epoch
+    def get(self, query, params=None, namespace=None):
+        key = cache_key(query, params, namespace)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM entries WHERE key = ? AND created > ? AND epoch = (SELECT value FROM meta WHERE name = 'epoch')",
+                (key, now - self.ttl)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        return pickle.loads(row[0])
+
+    # epoch is the epoch read before the query ran. A write that bumped the epoch while the query
+    # was in flight supersedes it, and the result is dropped rather than cached as fresh
+    def set(self, query, params, value, namespace=None, epoch=None):
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(blob) > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            current = self._conn.execute("SELECT value FROM meta WHERE name = 'epoch'").fetchone()[0]
+            epoch = current if epoch is None else epoch
+            if epoch < current:
+                return
+            self._conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                               (cache_key(query, params, namespace), epoch, now, now, len(blob), blob))
+            self._evict(now)
+
+    # Drops expired entries, then the least recently used ones until the cache fits in max_bytes
+    def _evict(self, now):
+        self._conn.execute("DELETE FROM entries WHERE created <= ?", (now - self.ttl,))
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self._conn.execute("SELECT key, size FROM entries ORDER BY accessed").fetchall():
+            self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM entries")
+
+    def stats(self):
+        with self._lock:
+            count, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        return {'entries': count, 'bytes': size, 'hits': self.hits, 'misses': self.misses, 'epoch': self.epoch()}
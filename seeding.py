@@ -0,0 +1,314 @@
+import os
+from functools import partial
+from multiprocessing import Pool
+
+try:
+    from .models import Entity, Interaction, Attribute, Edge, AliasTable, dedupe_nodes, dedupe_edges
+except:
+    print("Import error, assuming module called directly")
+    from models import Entity, Interaction, Attribute, Edge, AliasTable, dedupe_nodes, dedupe_edges
+
+"""
+Seeding from parse files (promoted from the manual_seeding notebook)
+
+A parse file (<doc>_parse.txt) has an "Entities:" section followed by an
+"Interactions:" section, one entry per line:
+
+    Entities:
+    Uber [ride-share, company]
+    Interactions:
+    Uber, Lyft [release (scheduled, next week)] earnings preview
+
+Files are read one line at a time, so a document never needs to fit in memory,
+and seed_directory parses a whole folder of documents on a process pool.
+
+Nodes get content-addressed keys (see models.content_key) so batches can be
+deduped client-side and merged by key server-side:
+- entities are unscoped, so the same entity is shared across documents
+- attributes are scoped to their document
+- interactions are scoped to their document and position, so each occurrence stays distinct
+"""
+PARSE_SUFFIX = "_parse.txt"
+ENTITIES_HEADER = "Entities:"
+INTERACTIONS_HEADER = "Interactions:"
+
+NODE_CLASSES = {
+    'entity': Entity,
+    'interaction': Interaction,
+    'attribute': Attribute,
+}
+
+# Line Parsing Helpers
+# Parses an entity line in the format "ent [content1, content2]"
+def parse_entity_line(line):
+    if '[' in line:
+        ent, contents = line.split('[', maxsplit=1)
+        contents = [c.strip() for c in contents.strip()[:-1].split(',')]
+    else:
+        ent, contents = line, []
+    return ent.strip(), list(set(contents))
+
+def parse_entities(entity_lines):
+    ent_map = dict()
+    for line in entity_lines:
+        ent, contents = parse_entity_line(line)
+        assert ent not in ent_map.keys(), f"Error: entity {ent} already exists in entity map"
+        ent_map[ent] = contents
+    return ent_map
+
+def split_attributes(chunk):
+    # If no attributes
+    if "(" not in chunk:
+        return chunk, None
+
+    # Otherwise get attributes
+    ent, attrs = chunk.split('(', maxsplit=1)
+    attrs = [attr.strip() for attr in attrs.strip()[:-1].split(',')]
+    return ent.strip(), attrs
+
+def split_chunks(ent_string):
+    # Typically, chunks are split on commas. However, nested actions need to be regarded as a chunk so they must be recombined
+    # E.g. Stef, {Will, Neil [eat]} -> ["Stef", "{Will, Neil [eat]}"] and not ["Stef", "{Will", "Neil [eat]}"]
+    # Commas are only split on at bracket depth 0, which also handles nested {} chunks
+    pairs = {')': '(', ']': '[', '}': '{'}
+    stack = []
+    chunks = []
+    current = []
+    for ch in ent_string:
+        if ch in pairs.values():
+            stack.append(ch)
+        elif ch in pairs.keys():
+            assert stack and stack.pop() == pairs[ch], "Error: misordered brackets in line: " + ent_string
+        elif ch == ',' and not stack:
+            chunks.append("".join(current))
+            current = []
+            continue
+        current.append(ch)
+    assert not stack, "Mismatch brackets in line: " + ent_string
+    chunks.append("".join(current))
+    return [chunk.strip() for chunk in chunks]
+
+# Returns the (start, end) indexes of the action brackets of an SVO line: the first [...] at depth 0,
+# so brackets inside nested {} actions or () attributes are skipped
+def find_action(line):
+    pairs = {')': '(', ']': '[', '}': '{'}
+    stack = []
+    start = None
+    for i, ch in enumerate(line):
+        if ch in pairs.values():
+            if ch == '[' and not stack and start is None:
+                start = i
+            stack.append(ch)
+        elif ch in pairs.keys():
+            assert stack and stack.pop() == pairs[ch], "Error: misordered brackets in line: " + line
+            if ch == ']' and not stack and start is not None:
+                return start, i
+    raise ValueError("Error: no [action] found in line: " + line)
+
+# Adds a single (non-nested) entity chunk and its attributes, returns the entity's index
+def _add_entity(nodes, edges, chunk):
+    ent, attrs = split_attributes(chunk)
+    ent_idx = len(nodes)
+    nodes.append((ent, 'entity'))
+    # Add any attributes
+    if attrs:
+        for attr in attrs:
+            edges.append((len(nodes), ent_idx))
+            nodes.append((attr, 'attribute'))
+    return ent_idx
+
+# Parse a line in the Subject-Verb-Object format "ent1, ent2,... [action] ent3, ent4..."
+# Nodes are (text, type) tuples and edges are (source_idx, dest_idx) tuples into nodes
+def parse_SVO(nodes, edges, line):
+    # Split around the action, e.g. "Stef, {Will, Neil [eat]} [watch] TV" -> "Stef, {Will, Neil [eat]}", "watch", "TV"
+    start, end = find_action(line)
+    subj_ents = filter(None, split_chunks(line[:start])) # Drop empty entries
+    action = line[start + 1:end]
+    obj_ents = filter(None, split_chunks(line[end + 1:])) # Drop empty entries
+
+    # Get attributes
+    action, action_attrs = split_attributes(action)
+    # Action is always appended first
+    action_idx = len(nodes)
+    nodes.append((action.strip(), 'interaction'))
+
+    # Add edges
+    for ent in subj_ents:
+        if ent[0] == '{':
+            # Nested action is always appended first
+            new_action_idx = len(nodes)
+            nodes, edges = parse_SVO(nodes, edges, ent[1:-1])
+            edges.append((new_action_idx, action_idx))
+        else:
+            edges.append((_add_entity(nodes, edges, ent), action_idx))
+
+    for ent in obj_ents:
+        if ent[0] == '{':
+            new_action_idx = len(nodes)
+            nodes, edges = parse_SVO(nodes, edges, ent[1:-1])
+            edges.append((action_idx, new_action_idx))
+        else:
+            edges.append((action_idx, _add_entity(nodes, edges, ent)))
+
+    if action_attrs:
+        for attr in action_attrs:
+            edges.append((len(nodes), action_idx))
+            nodes.append((attr, 'attribute'))
+
+    return nodes, edges
+
+# Parse all interactions
+def parse_interactions(interaction_lines):
+    nodes, edges = [], []
+    for line in interaction_lines:
+        if len(line) == 0:
+            continue
+        nodes, edges = parse_SVO(nodes, edges, line)
+    return nodes, edges
+
+# Streaming Methods
+def doc_name_from_path(path):
+    name = os.path.basename(path)
+    if name.endswith(PARSE_SUFFIX):
+        name = name[:-len(PARSE_SUFFIX)]
+    return name
+
+# Yields (section, line) for every non-empty line of a parse file, reading one line at a time
+def iter_parse_file(path):
+    section = None
+    seen = set()
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            if line in [ENTITIES_HEADER, INTERACTIONS_HEADER]:
+                section = line[:-1].lower()
+                seen.add(line)
+                continue
+            if section is None:
+                continue
+            yield section, line
+    assert ENTITIES_HEADER in seen, "Error: did not find '{}' header in {}".format(ENTITIES_HEADER, path)
+    assert INTERACTIONS_HEADER in seen, "Error: did not find '{}' header in {}".format(INTERACTIONS_HEADER, path)
+
+# Returns the key scope of a parsed node, offset + i is its position in the document
+def node_scope(type_, parent_doc, position):
+    if type_ == 'entity':
+        return None
+    elif type_ == 'attribute':
+        return parent_doc
+    return "{}#{}".format(parent_doc, position)
+
+# Converts parsed (text, type) tuples to node models with content-addressed keys
+def build_nodes(nodes, parent_doc, offset=0, aliases=None):
+    aliases = aliases if aliases is not None else AliasTable()
+    node_objs = []
+    for i, (name, type_) in enumerate(nodes):
+        assert type_ in NODE_CLASSES, "Error, unrecognized type: " + str(type_)
+        key = aliases.key_for(name, type_, scope=node_scope(type_, parent_doc, offset + i))
+        node_objs.append(NODE_CLASSES[type_](key, name, parent_doc))
+    return node_objs
+
+# Streams a parse file into deduped (nodes, edges) batches of models
+# Batches are cut on line boundaries so every edge's endpoints are in its own or an earlier batch
+def iter_document_batches(path, parent_doc=None, batch_size=500, stats=None, aliases=None):
+    if parent_doc is None:
+        parent_doc = doc_name_from_path(path)
+    stats = stats if stats is not None else dict()
+    stats.update({'doc': parent_doc, 'lines': 0, 'skipped': 0, 'nodes': 0, 'edges': 0})
+    entities = set()
+    node_batch, edge_batch = [], []
+    offset = 0
+    for section, line in iter_parse_file(path):
+        if section == 'entities':
+            ent, _ = parse_entity_line(line)
+            assert ent not in entities, f"Error: entity {ent} already exists in entity map"
+            entities.add(ent)
+            continue
+
+        stats['lines'] += 1
+        try:
+            nodes, edges = parse_SVO([], [], line)
+        except (AssertionError, ValueError, IndexError) as e:
+            print("Skipping line in {}: {} ({})".format(parent_doc, line, e))
+            stats['skipped'] += 1
+            continue
+        node_objs = build_nodes(nodes, parent_doc, offset=offset, aliases=aliases)
+        node_batch.extend(node_objs)
+        edge_batch.extend([Edge("relation", node_objs[source], node_objs[dest]) for source, dest in edges])
+        offset += len(nodes)
+        stats['nodes'] += len(node_objs)
+        stats['edges'] += len(edges)
+
+        if len(node_batch) >= batch_size:
+            yield dedupe_nodes(node_batch), dedupe_edges(edge_batch)
+            node_batch, edge_batch = [], []
+
+    if node_batch or edge_batch:
+        yield dedupe_nodes(node_batch), dedupe_edges(edge_batch)
+
+# Parses a whole document into lists of node and edge models
+def parse_document(path, parent_doc=None, aliases=None):
+    node_objs, edge_objs = [], []
+    for nodes, edges in iter_document_batches(path, parent_doc=parent_doc, batch_size=float('inf'), aliases=aliases):
+        node_objs.extend(nodes)
+        edge_objs.extend(edges)
+    return node_objs, edge_objs
+
+# Multi-process Seeding
+_worker_driver = None
+_worker_aliases = None
+
+def _get_driver_class():
+    try:
+        from .graph_driver import GraphDBDriver
+    except:
+        from graph_driver import GraphDBDriver
+    return GraphDBDriver
+
+def _init_worker(remote, aliases):
+    global _worker_driver, _worker_aliases
+    _worker_driver = _get_driver_class()(remote=remote)
+    _worker_aliases = AliasTable(aliases)
+
+# Parses one document in a worker process and merges its batches as they are produced
+def _seed_file(path, doc_prefix="", batch_size=500):
+    stats = dict()
+    parent_doc = doc_prefix + doc_name_from_path(path)
+    try:
+        for nodes, edges in iter_document_batches(path, parent_doc=parent_doc, batch_size=batch_size, stats=stats, aliases=_worker_aliases):
+            _worker_driver.merge_nodes(nodes)
+            _worker_driver.merge_edges(edges)
+    except Exception as e:
+        print("Failed to seed {}: {}".format(path, e))
+        stats['error'] = str(e)
+    return stats
+
+def list_parse_files(directory):
+    return sorted([os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(PARSE_SUFFIX)])
+
+"""
+Parses every *_parse.txt file in a directory on a process pool
+Each worker holds its own GraphDBDriver and merges its batches directly
+Returns a list of per-document stats dictionaries
+"""
+def seed_directory(directory, remote=False, processes=None, batch_size=500, doc_prefix="", aliases=None):
+    paths = list_parse_files(directory)
+    print("Seeding {} documents from {}".format(len(paths), directory))
+
+    # Key constraints keep concurrent MERGEs from different workers from duplicating nodes
+    driver = _get_driver_class()(remote=remote)
+    driver.create_key_constraints(NODE_CLASSES.keys())
+    driver.close()
+
+    aliases = aliases.to_dict() if aliases is not None else dict()
+    results = []
+    with Pool(processes=processes, initializer=_init_worker, initargs=(remote, aliases)) as pool:
+        seed = partial(_seed_file, doc_prefix=doc_prefix, batch_size=batch_size)
+        for stats in pool.imap_unordered(seed, paths):
+            results.append(stats)
+            print("Seeded {} ({}/{}): {} nodes, {} edges".format(stats.get('doc'), len(results), len(paths), stats.get('nodes', 0), stats.get('edges', 0)))
+    failed = [stats for stats in results if 'error' in stats]
+    print("Finished seeding {} documents ({} failed)".format(len(results) - len(failed), len(failed)))
+    return results
@@ -0,0 +1,259 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from .graph_driver import QueryError, batches, group_by, stable_partition
+    from .models import dedupe_nodes
+except:
+    print("Import error, assuming module called directly")
+    from graph_driver import QueryError, batches, group_by, stable_partition
+    from models import dedupe_nodes
+
+"""
+Partitioned multi-instance routing
+
+ShardedGraphDriver is a facade over several GraphDBDriver instances (shards).
+Writes are routed by a partition function, reads are fanned out to every shard in
+parallel and their results merged.
+
+Partitioning
+    By default a node lives on stable_partition(parent_doc) (or its key when it has no
+    parent_doc), so each document's subgraph is colocated and most edges stay on one shard.
+    An unscoped entity (see models.content_key) seen in documents on different shards is
+    stored once per shard; key lookups and time-range queries merge those copies by summing
+    raw_count, and counts count each (type, key) once.
+
+Cross-shard edges
+    An edge is stored on the shard of its source node. If the destination node lives on a
+    different shard, a "ghost" stub (key, type, ghost=true) of it is merged on the source's
+    shard so the edge has a local endpoint. Ghosts are filtered out of key lookups, counts and
+    time-range queries, and dropped from raw_query/structured_query results parsed with
+    parse_nodes=True. Unparsed records are returned as the shards sent them, so queries
+    written against the shards directly should filter with GHOST_FILTER. Following an edge
+    into a ghost is done by looking its key up across shards (query_nodes_by_key).
+
+Node placement ((key, type) -> shards holding it) is cached for routing edges, keeping the
+max_placement most recently used entries. Evicted entries are looked up again when needed.
+"""
+DEFAULT_MAX_PLACEMENT = 100000
+GHOST_FILTER = "coalesce(node.ghost, false) = false"
+
+# Raised by ShardedGraphDriver.raw_query when any shard fails. failures maps shard index -> QueryError,
+# partial holds the merged results of the shards that succeeded
+class ShardQueryError(QueryError):
+    def __init__(self, failures, partial, query=None):
+        super().__init__("Query failed on shard(s) {}: {}".format(sorted(failures), "; ".join(str(e) for e in failures.values())), query=query)
+        self.failures = failures
+        self.partial = partial
+
+# Default partition function: by parent_doc, falling back to the node key
+def partition_by_parent_doc(node, shard_count):
+    return stable_partition(node.parent_doc if node.parent_doc else node.key, shard_count)
+
+# Drops ghost stubs from parsed node models
+def drop_ghosts(nodes):
+    return [node for node in nodes if not (node is not None and node.attrs.get('ghost'))]
+
+class ShardedGraphDriver:
+    """
+    Main methods:
+        merge_nodes / merge_edges: Route writes to shards, creating ghost stubs for cross-shard edges
+        raw_query / structured_query: Scatter a read to every shard and concatenate the results (ShardQueryError if a shard fails)
+        query_nodes_by_key: Key lookup across shards, merging duplicate copies
+        count: Number of distinct nodes across shards
+        query_time_range: Time-ranged node query across shards, merged in time order
+    """
+    def __init__(self, drivers, partition_fn=partition_by_parent_doc, max_workers=None, max_placement=DEFAULT_MAX_PLACEMENT):
+        assert len(drivers) > 0, "Error: at least one shard driver is required"
+        self.shards = list(drivers)
+        self.partition_fn = partition_fn
+        self.max_placement = max_placement
+        self.placement = OrderedDict() # (key, type) -> set of shard indexes holding the node, least recently used first
+        self._executor = ThreadPoolExecutor(max_workers=max_workers or len(self.shards))
+
+    def close(self):
+        self._executor.shutdown()
+        for shard in self.shards:
+            shard.close()
+
+    def shard_for(self, node):
+        return self.partition_fn(node, len(self.shards))
+
+    # Runs fn(shard_index, shard) on every shard (or the given indexes) in parallel, returns results in shard order
+    def scatter(self, fn, indexes=None):
+        indexes = list(range(len(self.shards))) if indexes is None else list(indexes)
+        return list(self._executor.map(lambda i: fn(i, self.shards[i]), indexes))
+
+    # Write Methods
+    def merge_nodes(self, nodes, batch_size=1000):
+        routed = group_by(dedupe_nodes(nodes), self.shard_for)
+        for index, shard_nodes in routed.items():
+            for node in shard_nodes:
+                self._place((node.key, node.type), [index])
+        def write(i, shard):
+            count = shard.merge_nodes(routed[i], batch_size=batch_size)
+            # Nodes that already had a ghost stub on their home shard take over the stub
+            for node_type, typed_nodes in group_by(routed[i], lambda node: node.type).items():
+                query = "\n".join([
+                    "UNWIND $rows AS row",
+                    "MATCH (node:{} {{key: row.key}})".format(node_type),
+                    "WHERE node.ghost",
+                    "SET node += row, node.ghost = null, node.home_shards = null",
+                ])
+                for batch in batches(typed_nodes, batch_size):
+                    shard.raw_query(query, params={'rows': [shard._strip_nulls(node.to_dict()) for node in batch]})
+            return count
+        return sum(self.scatter(write, routed.keys()))
+
+    def merge_edges(self, edges, batch_size=1000):
+        placement = self.locate([(edge.source_key, edge.source_type) for edge in edges] + [(edge.dest_key, edge.dest_type) for edge in edges])
+        routed = dict()
+        ghosts = dict() # shard index -> {(key, type): home shards}
+        for edge in edges:
+            sources = placement.get((edge.source_key, edge.source_type), set())
+            dests = placement.get((edge.dest_key, edge.dest_type), set())
+            if not sources:
+                print("Skipping edge with unknown source node:", str(edge))
+                continue
+            # Prefer a shard that holds both endpoints
+            shared = sources & dests
+            index = min(shared) if shared else min(sources)
+            routed.setdefault(index, []).append(edge)
+            if dests and index not in dests:
+                ghosts.setdefault(index, dict())[edge.dest_key, edge.dest_type] = sorted(dests)
+
+        def write(i, shard):
+            for node_type, stubs in group_by(ghosts.get(i, dict()).items(), lambda item: item[0][1]).items():
+                query = "\n".join([
+                    "UNWIND $rows AS row",
+                    "MERGE (node:{} {{key: row.key}})".format(node_type),
+                    "ON CREATE SET node.type = row.type, node.ghost = true, node.home_shards = row.home_shards",
+                ])
+                for batch in batches(stubs, batch_size):
+                    shard.raw_query(query, params={'rows': [{'key': key, 'type': node_type, 'home_shards': home} for (key, _), home in batch]})
+            return shard.merge_edges(routed[i], batch_size=batch_size)
+        return sum(self.scatter(write, routed.keys()))
+
+    # Delete Methods
+    # Run on every shard in parallel (ghost stubs are deleted along with real nodes) and reset node placement
+    def delete_nodes(self, keys, node_type=None, batch_size=1000):
+        keys = list(keys)
+        return self._scatter_delete(lambda i, shard: shard.delete_nodes(keys, node_type=node_type, batch_size=batch_size))
+
+    def delete_by_parent_doc(self, parent_doc, node_types=None, batch_size=1000):
+        return self._scatter_delete(lambda i, shard: shard.delete_by_parent_doc(parent_doc, node_types=node_types, batch_size=batch_size))
+
+    def delete_edges(self, edges=None, label=None, batch_size=1000):
+        return self._scatter_delete(lambda i, shard: shard.delete_edges(edges=edges, label=label, batch_size=batch_size))
+
+    def _scatter_delete(self, fn):
+        try:
+            results = self.scatter(fn)
+        finally:
+            self.placement = OrderedDict()
+        return {'nodes': sum(result['nodes'] for result in results), 'edges': sum(result['edges'] for result in results)}
+
+    # Records that a (key, type) node is held by indexes, evicting the least recently used entries
+    def _place(self, node, indexes):
+        self.placement.setdefault(node, set()).update(indexes)
+        self.placement.move_to_end(node)
+        while len(self.placement) > self.max_placement:
+            self.placement.popitem(last=False)
+
+    # Returns {(key, type): shard indexes} for the given nodes, looking up the ones not in the placement cache
+    # Nodes found on no shard are left out
+    def locate(self, nodes):
+        found = dict()
+        missing = []
+        for node in set(nodes):
+            if node in self.placement:
+                self.placement.move_to_end(node)
+                found[node] = set(self.placement[node])
+            else:
+                missing.append(node)
+        if not missing:
+            return found
+        def lookup(i, shard):
+            found = []
+            for node_type, typed in group_by(missing, lambda node: node[1]).items():
+                query = "UNWIND $keys AS k MATCH (node:{} {{key: k}}) WHERE {} RETURN node.key AS key".format(node_type, GHOST_FILTER)
+                found += [(record['key'], node_type) for record in shard.raw_query(query, params={'keys': [key for key, _ in typed]})]
+            return found
+        for index, located in enumerate(self.scatter(lookup)):
+            for node in located:
+                found.setdefault(node, set()).add(index)
+        for node in missing:
+            if node in found:
+                self._place(node, found[node])
+        return found
+
+    # Read Methods
+    # Runs a query on every shard and concatenates the results
+    # Raises ShardQueryError if any shard fails, with the other shards' results attached as partial
+    def raw_query(self, query, parse_nodes=False, params=None, use_cache=False):
+        def run(i, shard):
+            try:
+                return shard.raw_query(query, parse_nodes=parse_nodes, params=params, use_cache=use_cache), None
+            except QueryError as e:
+                return [], e
+        results = self.scatter(run)
+        merged = [item for result, _ in results for item in result]
+        if parse_nodes:
+            merged = drop_ghosts(merged)
+        failures = {i: error for i, (_, error) in enumerate(results) if error is not None}
+        if failures:
+            raise ShardQueryError(failures, merged, query=query)
+        return merged
+
+    # Each shard applies LIMIT, and the merged result is cut back down to LIMIT
+    def structured_query(self, MATCH=None, WHERE=None, RETURN=None, LIMIT=10, parse_nodes=False, params=None, use_cache=False):
+        results = self.scatter(lambda i, shard: shard.structured_query(MATCH=MATCH, WHERE=WHERE, RETURN=RETURN, LIMIT=LIMIT, parse_nodes=parse_nodes, params=params, use_cache=use_cache))
+        merged = [item for result in results for item in result]
+        if parse_nodes:
+            merged = drop_ghosts(merged)
+        return merged[:LIMIT] if LIMIT else merged
+
+    # Looks keys up on every shard, merging copies of a node held by several shards
+    def query_nodes_by_key(self, keys, node_type, use_cache=False):
+        query = "UNWIND $keys AS k MATCH (node:{} {{key: k}}) WHERE {} RETURN node".format(node_type, GHOST_FILTER)
+        merged = dict()
+        for nodes in self.scatter(lambda i, shard: shard.raw_query(query, parse_nodes=True, params={'keys': list(keys)}, use_cache=use_cache)):
+            for node in nodes:
+                if node.key in merged:
+                    merged[node.key].raw_count += node.raw_count
+                else:
+                    merged[node.key] = node
+        return list(merged.values())
+
+    # Counts nodes matching MATCH/WHERE (the counted variable must be called node), excluding ghosts
+    # Copies of a node on several shards are counted once, by their (type, key)
+    def count(self, MATCH="(node)", WHERE=None, params=None, use_cache=False):
+        where = GHOST_FILTER if not WHERE else "({}) AND {}".format(WHERE, GHOST_FILTER)
+        RETURN = "count(node) - count(node.key) AS unkeyed, collect(DISTINCT [node.type, node.key]) AS keys"
+        results = self.scatter(lambda i, shard: shard.structured_query(MATCH=MATCH, WHERE=where, RETURN=RETURN, LIMIT=None, params=params, use_cache=use_cache))
+        keys = set()
+        unkeyed = 0
+        for result in results:
+            unkeyed += result[0]['unkeyed']
+            keys.update(tuple(pair) for pair in result[0]['keys'] if pair[1] is not None)
+        return unkeyed + len(keys)
+
+    # Nodes of a type with field_name in [start, end], merged across shards in field order
+    # Nodes without field_name sort last, as in Cypher. Copies of a node on several shards are merged
+    # like query_nodes_by_key (the first copy is kept, with raw_count summed when parse_nodes=True)
+    def query_time_range(self, node_type, field_name, start=None, end=None, LIMIT=100, parse_nodes=True, use_cache=False):
+        time_range = self.shards[0].format_time_range(field_name, start=start, end=end)
+        where = GHOST_FILTER if not time_range else "{} AND {}".format(time_range, GHOST_FILTER)
+        query = "MATCH (node:{}) WHERE {} RETURN node ORDER BY node.{} LIMIT {}".format(node_type, where, field_name, int(LIMIT))
+        records = self.raw_query(query, params=None, use_cache=use_cache)
+        records = sorted(records, key=lambda record: (record['node'].get(field_name) is None, record['node'].get(field_name)))
+        merged = OrderedDict()
+        for record in records:
+            key = record['node'].get('key')
+            if key is None:
+                merged[id(record)] = self.shards[0].record_to_models(record)['node'] if parse_nodes else record
+            elif key not in merged:
+                merged[key] = self.shards[0].record_to_models(record)['node'] if parse_nodes else record
+            elif parse_nodes:
+                merged[key].raw_count += record['node'].get('raw_count', 1)
+        return list(merged.values())[:LIMIT]
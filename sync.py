@@ -0,0 +1,226 @@
+import json, os
+
+try:
+    from .graph_driver import INGESTED_AT, group_by
+except:
+    print("Import error, assuming module called directly")
+    from graph_driver import INGESTED_AT, group_by
+
+"""
+Watermark-based incremental sync between two graphs (e.g. LOCAL_GRAPH_* -> REMOTE_GRAPH_*)
+
+Every upload/merge through GraphDBDriver stamps nodes and edges with an ingested_at server
+timestamp. GraphSync keeps a watermark per node type and edge label: the (ingested_at, key)
+of the last node, or (ingested_at, id) of the last edge, that was applied to the target.
+Each pass pulls only items past the watermark from the source, in ingested_at order and in
+batches, and merges them into the target by key.
+
+ingested_at is the server time when the writing statement started, not when it committed, so
+a transaction stamped T can become visible after a pass has moved the watermark past T. To
+never skip such rows, a pass only pulls items stamped at least safety_lag ms before the
+server's current time. safety_lag must be longer than the slowest write transaction (e.g. a
+merge batch from seed_directory or the bulk loader); the rest is picked up by the next pass.
+
+run() reads the cutoff once and uses it for every node type and edge label. Nodes are synced
+before edges, but an edge can still reach the target before its endpoint: merge_nodes re-stamps
+a shared entity each time it is merged again, which can move it past the cutoff. Edge sync
+therefore merges missing endpoints as stubs (key and type only) that the endpoint's own node
+sync fills in later, and checks that every pulled edge was written before moving the
+watermark. Edges whose endpoints have no key or type can't be matched on the target; their
+ids are recorded under 'unsynced' in the state and reported.
+
+The watermark is saved after every applied batch, so an interrupted sync resumes where it
+stopped. Re-applying a batch is harmless since items are merged by key. The state file holds
+one entry per (source uri, target uri) pair, so syncs in either direction keep their own
+watermarks.
+
+    sync = GraphSync(GraphDBDriver(remote=False), GraphDBDriver(remote=True))
+    sync.ensure_indexes()
+    sync.run()
+
+Deletions are not propagated, and data written before ingested_at stamping existed needs
+backfill_watermarks() once before it can be synced.
+"""
+DEFAULT_STATE_PATH = "output/sync_state.json"
+DEFAULT_SAFETY_LAG = 5 * 60 * 1000 # ms
+
+class GraphSync:
+    def __init__(self, source, target, state_path=DEFAULT_STATE_PATH, batch_size=1000, safety_lag=DEFAULT_SAFETY_LAG):
+        self.source = source
+        self.target = target
+        self.state_path = state_path
+        self.batch_size = batch_size
+        self.safety_lag = safety_lag
+        self.state_key = "{} -> {}".format(getattr(source, 'uri', None), getattr(target, 'uri', None))
+        self.state = self.load_state()
+
+    # State Methods
+    @staticmethod
+    def empty_state():
+        return {'nodes': dict(), 'edges': dict(), 'unsynced': dict()}
+
+    # Reads every pair's entry from the state file
+    def _read_states(self):
+        if not os.path.exists(self.state_path):
+            return dict()
+        with open(self.state_path) as f:
+            states = json.load(f)
+        if 'nodes' in states:
+            # Older state files held a single watermark set without saying which sync it was for
+            print("Warning: ignoring unkeyed sync state in", self.state_path)
+            return dict()
+        return states
+
+    def load_state(self):
+        state = self.empty_state()
+        state.update(self._read_states().get(self.state_key, dict()))
+        return state
+
+    # Writes to a temporary file first so an interruption never leaves a half-written state
+    # Other pairs' entries are read back and kept
+    def save_state(self):
+        if os.path.dirname(self.state_path):
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        states = self._read_states()
+        states[self.state_key] = self.state
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(states, f, indent=2)
+        os.replace(tmp_path, self.state_path)
+
+    def reset(self):
+        self.state = self.empty_state()
+        self.save_state()
+
+    # Schema Methods
+    def node_types(self):
+        return [record['label'] for record in self._query(self.source, "CALL db.labels() YIELD label RETURN label")]
+
+    def edge_labels(self):
+        return [record['label'] for record in self._query(self.source, "CALL db.relationshipTypes() YIELD relationshipType AS label RETURN label")]
+
+    # Indexes on ingested_at keep each pull proportional to the delta instead of the graph
+    def ensure_indexes(self):
+        for node_type in self.node_types():
+            self._query(self.source, "CREATE INDEX {}_{} IF NOT EXISTS FOR (n:{}) ON (n.{})".format(INGESTED_AT, node_type, node_type, INGESTED_AT))
+        for label in self.edge_labels():
+            self._query(self.source, "CREATE INDEX {}_{} IF NOT EXISTS FOR ()-[e:{}]-() ON (e.{})".format(INGESTED_AT, label, label, INGESTED_AT))
+
+    # Stamps nodes and edges written before ingested_at existed, in batches
+    def backfill_watermarks(self):
+        count = 0
+        for query in ["MATCH (n) WHERE n.{0} IS NULL WITH n LIMIT $batch_size SET n.{0} = timestamp() RETURN count(n) AS count",
+                      "MATCH ()-[e]->() WHERE e.{0} IS NULL WITH e LIMIT $batch_size SET e.{0} = timestamp() RETURN count(e) AS count"]:
+            while True:
+                stamped = self._query(self.source, query.format(INGESTED_AT), batch_size=self.batch_size)[0]['count']
+                count += stamped
+                if stamped < self.batch_size:
+                    break
+        print("Backfilled {} watermarks".format(count))
+        return count
+
+    # Sync Methods
+    # Syncs every node type and then every edge label up to one cutoff, returns the number of items applied
+    def run(self, node_types=None, edge_labels=None):
+        node_types = node_types if node_types is not None else self.node_types()
+        edge_labels = edge_labels if edge_labels is not None else self.edge_labels()
+        cutoff = self.cutoff()
+        counts = {'nodes': 0, 'edges': 0}
+        for node_type in node_types:
+            counts['nodes'] += self.sync_nodes(node_type, cutoff=cutoff)
+        for label in edge_labels:
+            counts['edges'] += self.sync_edges(label, cutoff=cutoff)
+        print("Synced {} nodes and {} edges".format(counts['nodes'], counts['edges']))
+        return counts
+
+    def sync_nodes(self, node_type, cutoff=None):
+        stamp, key = self.state['nodes'].get(node_type, [-1, ""])
+        cutoff = cutoff if cutoff is not None else self.cutoff()
+        pull = "\n".join([
+            "MATCH (node:{})".format(node_type),
+            "WHERE node.{0} <= $cutoff AND (node.{0} > $stamp OR (node.{0} = $stamp AND node.key > $key))".format(INGESTED_AT),
+            "RETURN node.key AS key, node.{} AS stamp, properties(node) AS props".format(INGESTED_AT),
+            "ORDER BY node.{}, node.key".format(INGESTED_AT),
+            "LIMIT $batch_size",
+        ])
+        apply = "\n".join([
+            "UNWIND $rows AS row",
+            "MERGE (node:{} {{key: row.key}})".format(node_type),
+            "SET node = row.props",
+        ])
+        count = 0
+        while True:
+            records = self._query(self.source, pull, stamp=stamp, key=key, cutoff=cutoff, batch_size=self.batch_size)
+            if not records:
+                break
+            self._query(self.target, apply, rows=[{'key': record['key'], 'props': record['props']} for record in records])
+            stamp, key = records[-1]['stamp'], records[-1]['key']
+            self.state['nodes'][node_type] = [stamp, key]
+            self.save_state()
+            count += len(records)
+            print("Synced {} {} nodes".format(count, node_type))
+            if len(records) < self.batch_size:
+                break
+        return count
+
+    # Edges are identified on the target by label and endpoint keys
+    def sync_edges(self, label, cutoff=None):
+        stamp, edge_id = self.state['edges'].get(label, [-1, -1])
+        cutoff = cutoff if cutoff is not None else self.cutoff()
+        pull = "\n".join([
+            "MATCH (a)-[edge:{}]->(b)".format(label),
+            "WHERE edge.{0} <= $cutoff AND (edge.{0} > $stamp OR (edge.{0} = $stamp AND id(edge) > $edge_id))".format(INGESTED_AT),
+            "RETURN a.key AS source_key, a.type AS source_type, b.key AS dest_key, b.type AS dest_type,",
+            "    id(edge) AS edge_id, edge.{} AS stamp, properties(edge) AS props".format(INGESTED_AT),
+            "ORDER BY edge.{}, id(edge)".format(INGESTED_AT),
+            "LIMIT $batch_size",
+        ])
+        count = 0
+        while True:
+            records = self._query(self.source, pull, stamp=stamp, edge_id=edge_id, cutoff=cutoff, batch_size=self.batch_size)
+            if not records:
+                break
+            # Edges to nodes without a key or type can't be matched on the target
+            keyed = [record for record in records if self._has_endpoint_keys(record)]
+            unkeyed = [record['edge_id'] for record in records if not self._has_endpoint_keys(record)]
+            for (source_type, dest_type), typed_records in group_by(keyed, lambda record: (record['source_type'], record['dest_type'])).items():
+                # Endpoints that haven't been synced yet are created as stubs for their node sync to fill in
+                apply = "\n".join([
+                    "UNWIND $rows AS row",
+                    "MERGE (a:{} {{key: row.source_key}})".format(source_type),
+                    "ON CREATE SET a.type = $source_type",
+                    "MERGE (b:{} {{key: row.dest_key}})".format(dest_type),
+                    "ON CREATE SET b.type = $dest_type",
+                    "MERGE (a)-[edge:{}]->(b)".format(label),
+                    "SET edge = row.props",
+                    "RETURN count(edge) AS count",
+                ])
+                rows = [{'source_key': record['source_key'], 'dest_key': record['dest_key'], 'props': record['props']} for record in typed_records]
+                applied = self._query(self.target, apply, rows=rows, source_type=source_type, dest_type=dest_type)[0]['count']
+                if applied != len(rows):
+                    raise RuntimeError("Only {} of {} {} edges were written to the target, watermark not advanced".format(applied, len(rows), label))
+            if unkeyed:
+                print("Warning: {} {} edges have endpoints without a key or type and can't be synced".format(len(unkeyed), label))
+                self.state['unsynced'].setdefault(label, []).extend(unkeyed)
+            stamp, edge_id = records[-1]['stamp'], records[-1]['edge_id']
+            self.state['edges'][label] = [stamp, edge_id]
+            self.save_state()
+            count += len(records)
+            print("Synced {} {} edges".format(count, label))
+            if len(records) < self.batch_size:
+                break
+        return count
+
+    # Newest ingested_at a pass may pull: server time minus safety_lag
+    # run() reads it once so every node type and edge label walks up to the same point
+    def cutoff(self):
+        return self._query(self.source, "RETURN timestamp() - $lag AS cutoff", lag=self.safety_lag)[0]['cutoff']
+
+    @staticmethod
+    def _has_endpoint_keys(record):
+        return bool(record['source_key'] and record['dest_key'] and record['source_type'] and record['dest_type'])
+
+    # raw_query raises QueryError on failure, so a failed batch never advances a watermark
+    @staticmethod
+    def _query(driver, query, **params):
+        return driver.raw_query(query, params=params)
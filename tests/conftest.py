@@ -0,0 +1,5 @@
+import os, sys
+
+# The package is a flat directory of modules; each falls back to absolute imports when
+# imported on its own, so tests import them by module name
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
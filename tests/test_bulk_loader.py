@@ -0,0 +1,85 @@
+import itertools, threading, time
+import pytest
+
+pytest.importorskip("neo4j")
+
+from models import Node, Edge
+from bulk_loader import ParallelBulkLoader, pair_rounds
+
+# Stands in for GraphDBDriver: records the node keys each in-flight merge locks and flags
+# any key that two concurrent merges hold at once
+class LockingDriver:
+    def __init__(self, delay=0.005):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.held = dict()
+        self.conflicts = []
+        self.most_in_flight = 0
+        self.in_flight = 0
+        self.merged = []
+
+    def _hold(self, keys, items):
+        with self.lock:
+            shared = keys & set(self.held)
+            if shared:
+                self.conflicts.append(shared)
+            for key in keys:
+                self.held[key] = self.held.get(key, 0) + 1
+            self.in_flight += 1
+            self.most_in_flight = max(self.most_in_flight, self.in_flight)
+        time.sleep(self.delay)
+        with self.lock:
+            for key in keys:
+                self.held[key] -= 1
+                if not self.held[key]:
+                    del self.held[key]
+            self.in_flight -= 1
+            self.merged.extend(items)
+        return len(items)
+
+    def merge_nodes(self, nodes, batch_size=1000):
+        return self._hold({node.key for node in nodes}, nodes)
+
+    def merge_edges(self, edges, batch_size=1000):
+        return self._hold({key for edge in edges for key in [edge.source_key, edge.dest_key]}, edges)
+
+def make_graph(count=60):
+    nodes = [Node("n{}".format(i), "N{}".format(i), 'entity') for i in range(count)]
+    edges = [Edge("relation", a, b) for a, b in itertools.combinations(nodes, 2) if (int(a.key[1:]) * 7 + int(b.key[1:])) % 5 == 0]
+    edges += [Edge("relation", node, node) for node in nodes[:5]]
+    return nodes, edges
+
+@pytest.mark.parametrize("n", [1, 2, 3, 4, 7, 8, 16])
+def test_pair_rounds_cover_every_pair_once(n):
+    rounds = pair_rounds(n)
+    pairs = [pair for pairs in rounds for pair in pairs]
+    assert sorted(pairs) == [(a, b) for a in range(n) for b in range(a, n)]
+    for pairs in rounds:
+        used = [p for pair in pairs for p in set(pair)]
+        assert len(used) == len(set(used))
+
+def test_driver_flags_shared_keys():
+    driver = LockingDriver(delay=0.05)
+    a, b, c = [Node(key, key, 'entity') for key in "abc"]
+    threads = [threading.Thread(target=driver.merge_edges, args=([edge],)) for edge in [Edge("relation", a, b), Edge("relation", c, a)]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert driver.conflicts
+
+def test_concurrent_batches_never_share_a_node():
+    driver = LockingDriver()
+    nodes, edges = make_graph()
+    loader = ParallelBulkLoader(driver, workers=4, batch_size=10)
+    report = loader.load(nodes, edges)
+    assert not driver.conflicts
+    assert driver.most_in_flight > 1
+    assert report['nodes']['created'] == len(nodes) and report['edges']['created'] == len(edges)
+    assert sorted(edge.tup() for edge in driver.merged if isinstance(edge, Edge)) == sorted(edge.tup() for edge in edges)
+
+def test_load_edges_alone_never_shares_a_node():
+    driver = LockingDriver()
+    _, edges = make_graph()
+    ParallelBulkLoader(driver, workers=3, partitions=5).load_edges(edges)
+    assert not driver.conflicts
@@ -0,0 +1,16 @@
+import pytest
+
+pytest.importorskip("neo4j")
+pytest.importorskip("pyarrow")
+from neo4j.data import Record
+from neo4j.graph import Graph
+
+from columnar import records_to_columnar
+
+def test_properties_named_like_metadata_stay_aligned():
+    hydrator = Graph.Hydrator(Graph())
+    records = [Record(zip(['node'], [hydrator.hydrate_node(i, {'entity'}, {'id': 'x' + str(i), 'labels': 'l'})])) for i in range(3)]
+    table = records_to_columnar(records, 'arrow')
+    assert table.num_rows == 3
+    assert table.column('node.__id').to_pylist() == [0, 1, 2]
+    assert table.column('node.id').to_pylist() == ['x0', 'x1', 'x2']
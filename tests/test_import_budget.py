@@ -0,0 +1,39 @@
+import importlib.util, json, os, subprocess, sys
+
+import pytest
+
+"""
+Importing the package (models + GraphDBDriver) must stay cheap: plotting and seeding
+modules are loaded lazily on first attribute access (see __init__.py).
+Runs in a fresh interpreter so modules imported by other tests don't count.
+"""
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE = os.path.basename(PACKAGE_DIR)
+IMPORT_BUDGET_SECONDS = 1.0
+HEAVY_MODULES = ['networkx', 'pyvis', 'matplotlib', 'dotenv']
+
+pytestmark = pytest.mark.skipif(importlib.util.find_spec("neo4j") is None, reason="neo4j driver not installed")
+
+def measure_import(statement):
+    script = "\n".join([
+        "import json, sys, time",
+        "start = time.perf_counter()",
+        statement,
+        "seconds = time.perf_counter() - start",
+        "print(json.dumps({'seconds': seconds, 'modules': sorted(sys.modules)}))",
+    ])
+    output = subprocess.run([sys.executable, "-c", script], cwd=os.path.dirname(PACKAGE_DIR), capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def test_import_skips_heavy_modules():
+    result = measure_import("import {}".format(PACKAGE))
+    loaded = [name for name in HEAVY_MODULES if name in result['modules']]
+    assert not loaded, "Importing the package loaded " + str(loaded)
+
+def test_import_time_budget():
+    result = measure_import("from {} import GraphDBDriver, Entity, Edge".format(PACKAGE))
+    assert result['seconds'] < IMPORT_BUDGET_SECONDS, "Import took {:.2f}s, budget is {}s".format(result['seconds'], IMPORT_BUDGET_SECONDS)
+
+def test_lazy_attribute_loads_module():
+    result = measure_import("import {0}; {0}.seeding".format(PACKAGE))
+    assert PACKAGE + ".seeding" in result['modules']
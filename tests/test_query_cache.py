@@ -0,0 +1,55 @@
+import pytest
+
+neo4j = pytest.importorskip("neo4j")
+from neo4j.data import Record
+from neo4j.graph import Graph
+from neo4j.time import Date, DateTime, Duration
+
+from query_cache import QueryCache, freeze_records, thaw_records
+
+"""
+Cached results go through pickle, so every value a query can return must survive
+freeze_records -> QueryCache.set -> QueryCache.get -> thaw_records.
+"""
+@pytest.fixture
+def cache(tmp_path):
+    cache = QueryCache(str(tmp_path / "cache.sqlite"))
+    yield cache
+    cache.close()
+
+def round_trip(cache, records, namespace=None):
+    cache.set("MATCH (node) RETURN node", None, freeze_records(records), namespace=namespace)
+    return thaw_records(cache.get("MATCH (node) RETURN node", None, namespace=namespace))
+
+def test_node_with_datetime_round_trips(cache):
+    created_at = DateTime(2021, 7, 1, 12, 30, 15.123456789)
+    node = Graph.Hydrator(Graph()).hydrate_node(1, {'document'}, {'key': 'doc1', 'type': 'document', 'created_at': created_at})
+    records = round_trip(cache, [Record(zip(['node'], [node]))])
+    cached = records[0]['node']
+    assert cached.id == 1 and cached.labels == {'document'}
+    assert cached['key'] == 'doc1'
+    assert cached['created_at'] == created_at
+
+def test_temporal_values_round_trip(cache):
+    values = [Date(2021, 7, 1), DateTime(2021, 7, 1, 1, 2, 3), Duration(months=1, days=2, seconds=3, nanoseconds=4)]
+    records = round_trip(cache, [Record(zip(['date', 'datetime', 'duration'], values))])
+    assert list(records[0].values()) == values
+
+def test_namespaces_are_separate(cache):
+    cache.set("RETURN 1 AS n", None, freeze_records([Record(zip(['n'], [1]))]), namespace="bolt://local:7687")
+    assert cache.get("RETURN 1 AS n", None, namespace="bolt://remote:7687") is None
+    assert cache.get("RETURN 1 AS n", None, namespace="bolt://local:7687") is not None
+
+def test_zoned_datetime_keeps_its_zone(cache):
+    pytz = pytest.importorskip("pytz")
+    zoned = pytz.timezone("Europe/Berlin").localize(DateTime(2021, 7, 1, 12, 30, 15.123456789))
+    cached = round_trip(cache, [Record(zip(['at'], [zoned]))])[0]['at']
+    assert cached == zoned and cached.tzinfo.zone == "Europe/Berlin"
+
+def test_results_read_before_a_write_are_not_cached(cache):
+    epoch = cache.epoch()
+    cache.bump_epoch() # A write commits while the read is in flight
+    cache.set("MATCH (node) RETURN node", None, freeze_records([Record(zip(['n'], [1]))]), epoch=epoch)
+    assert cache.get("MATCH (node) RETURN node", None) is None
+    cache.set("MATCH (node) RETURN node", None, freeze_records([Record(zip(['n'], [2]))]), epoch=cache.epoch())
+    assert thaw_records(cache.get("MATCH (node) RETURN node", None))[0]['n'] == 2
@@ -0,0 +1,84 @@
+import pytest
+
+pytest.importorskip("neo4j")
+
+from seeding import split_chunks, find_action, parse_SVO, parse_entity_line, iter_document_batches, parse_document
+
+PARSE_FILE = """Entities:
+Uber [ride-share, company]
+Lyft [ride-share]
+Interactions:
+Uber, Lyft [release (scheduled, next week)] earnings preview
+Stef, {Will, Neil [eat]} [watch] TV
+no action on this line
+{status of food delivery [changing]} [affects] Uber
+Uber [affects] {status (food) [changing (fast)]}
+"""
+
+def write_parse_file(tmp_path, text=PARSE_FILE):
+    path = tmp_path / "doc_parse.txt"
+    path.write_text(text)
+    return str(path)
+
+def test_split_chunks_keeps_nested_actions_together():
+    assert split_chunks("Stef, {Will, Neil [eat]}") == ["Stef", "{Will, Neil [eat]}"]
+    assert split_chunks("Uber (big, fast), Lyft") == ["Uber (big, fast)", "Lyft"]
+    with pytest.raises(AssertionError):
+        split_chunks("{Will, Neil [eat]")
+
+def test_find_action_skips_nested_brackets():
+    line = "Stef, {Will, Neil [eat]} [watch] TV"
+    start, end = find_action(line)
+    assert line[start:end + 1] == "[watch]"
+    with pytest.raises(ValueError):
+        find_action("no action on this line")
+
+def test_entity_line():
+    ent, contents = parse_entity_line("Uber [ride-share, company]")
+    assert ent == "Uber" and sorted(contents) == ["company", "ride-share"]
+    assert parse_entity_line("Lyft") == ("Lyft", [])
+
+def test_attributes():
+    nodes, edges = parse_SVO([], [], "Uber, Lyft [release (scheduled, next week)] earnings preview")
+    assert nodes == [('release', 'interaction'), ('Uber', 'entity'), ('Lyft', 'entity'), ('earnings preview', 'entity'),
+                     ('scheduled', 'attribute'), ('next week', 'attribute')]
+    assert edges == [(1, 0), (2, 0), (0, 3), (4, 0), (5, 0)]
+
+def test_nested_subject_action():
+    nodes, edges = parse_SVO([], [], "Stef, {Will, Neil [eat]} [watch] TV")
+    assert nodes == [('watch', 'interaction'), ('Stef', 'entity'), ('eat', 'interaction'), ('Will', 'entity'),
+                     ('Neil', 'entity'), ('TV', 'entity')]
+    assert edges == [(1, 0), (3, 2), (4, 2), (2, 0), (0, 5)]
+
+def test_nested_subject_action_at_the_start():
+    nodes, edges = parse_SVO([], [], "{status of food delivery [changing]} [affects] Uber")
+    assert nodes == [('affects', 'interaction'), ('changing', 'interaction'), ('status of food delivery', 'entity'), ('Uber', 'entity')]
+    assert edges == [(2, 1), (1, 0), (0, 3)]
+
+def test_nested_object_action_with_attributes():
+    nodes, edges = parse_SVO([], [], "Uber [affects] {status (food) [changing (fast)]}")
+    assert nodes == [('affects', 'interaction'), ('Uber', 'entity'), ('changing', 'interaction'), ('status', 'entity'),
+                     ('food', 'attribute'), ('fast', 'attribute')]
+    assert edges == [(1, 0), (4, 3), (3, 2), (5, 2), (0, 2)]
+
+def test_batches_are_cut_on_line_boundaries(tmp_path):
+    path = write_parse_file(tmp_path)
+    full_nodes, full_edges = parse_document(path)
+    for batch_size in [1, 3, 5]:
+        stats = dict()
+        seen, edge_tups = set(), set()
+        for nodes, edges in iter_document_batches(path, batch_size=batch_size, stats=stats):
+            seen.update((node.key, node.type) for node in nodes)
+            for edge in edges:
+                assert (edge.source_key, edge.source_type) in seen and (edge.dest_key, edge.dest_type) in seen
+                edge_tups.add(edge.tup())
+        assert stats['lines'] == 5 and stats['skipped'] == 1
+        assert seen == {(node.key, node.type) for node in full_nodes}
+        assert edge_tups == {edge.tup() for edge in full_edges}
+
+def test_entities_are_shared_and_interactions_are_not(tmp_path):
+    nodes, _ = parse_document(write_parse_file(tmp_path))
+    assert len([node for node in nodes if node.title == "Uber"]) == 1
+    assert len([node for node in nodes if node.title == "affects"]) == 2
+    with pytest.raises(AssertionError):
+        parse_document(write_parse_file(tmp_path, "Entities:\nUber\n"))
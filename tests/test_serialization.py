@@ -0,0 +1,60 @@
+import datetime, random
+import pytest
+
+pytest.importorskip("neo4j")
+pytz = pytest.importorskip("pytz")
+from neo4j.time import DateTime
+from neo4j.time.hydration import hydrate_datetime
+
+from models import Node, Entity, Edge
+from serialization import encode_batch, decode_batch
+
+def round_trip(attrs):
+    node = Node('k', 'K', 'entity', attrs)
+    nodes, _ = decode_batch(encode_batch([node]))
+    return nodes[0].attrs
+
+def test_models_round_trip():
+    entity = Entity('alice', 'Alice', 'doc1', {'count': 3, 'score': 0.5, 'flag': True, 'tags': ['a', 'b'], 'big': 2**70})
+    entity.db_id = 7
+    other = Node('bob', 'Bob', 'entity')
+    edge = Edge('knows', entity, other)
+    nodes, edges = decode_batch(encode_batch([entity, other], [edge]))
+    assert type(nodes[0]) == Entity and nodes[0].parent_doc == 'doc1' and nodes[0].db_id == 7
+    assert nodes[0].attrs == entity.attrs and nodes[1].db_id is None
+    assert edges[0].tup() == edge.tup() and edges[0].time == edge.time
+
+def test_python_datetimes_keep_their_zone():
+    berlin = pytz.timezone("Europe/Berlin")
+    values = {
+        'naive': datetime.datetime(2021, 7, 1, 12, 30, 15, 123456),
+        'fixed': datetime.datetime(1901, 1, 1, tzinfo=datetime.timezone(datetime.timedelta(hours=-5, minutes=-30))),
+        'zoned': berlin.localize(datetime.datetime(2021, 10, 31, 2, 30), is_dst=True),
+    }
+    decoded = round_trip(values)
+    assert decoded == values
+    assert decoded['zoned'].tzinfo is values['zoned'].tzinfo
+    assert decoded['fixed'].utcoffset() == values['fixed'].utcoffset()
+
+def test_neo4j_datetimes_keep_nanoseconds_and_zone():
+    berlin = pytz.timezone("Europe/Berlin")
+    values = {
+        'naive': DateTime(2021, 7, 1, 12, 30, 15.123456789),
+        'fixed': DateTime(9999, 12, 31, 23, 59, 59.999999999, tzinfo=pytz.FixedOffset(-90)),
+        'zoned': berlin.localize(DateTime(2021, 3, 28, 3, 0, 0.000000001)),
+    }
+    decoded = round_trip(values)
+    assert decoded == values
+    assert decoded['zoned'].tzinfo is values['zoned'].tzinfo
+    assert decoded['naive'].hour_minute_second == (12, 30, 15.123456789)
+
+def test_neo4j_datetimes_from_the_driver_round_trip_exactly():
+    rng = random.Random(0)
+    zones = [None, 60, -330, "Europe/Berlin", "America/New_York"]
+    values = {str(i): hydrate_datetime(rng.randint(-2**34, 2**34), rng.randint(0, 999999999), rng.choice(zones)) for i in range(2000)}
+    assert round_trip(values) == values
+
+def test_datetimes_in_other_zones_fall_back_to_pickle():
+    zoneinfo = pytest.importorskip("zoneinfo")
+    value = datetime.datetime(2021, 7, 1, tzinfo=zoneinfo.ZoneInfo("Europe/Berlin"))
+    assert round_trip({'at': value, 'other': datetime.datetime(2021, 7, 1)})['at'] == value
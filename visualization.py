@@ -1,9 +1,7 @@
 # TODO: Fix everything. It sucks right now.
 
 import networkx as nx
-from networkx.drawing.nx_agraph import write_dot, graphviz_layout
 from pyvis.network import Network
-import matplotlib.pyplot as plt
 import random
 from .models import Node, Edge
 
@@ -25,66 +23,168 @@ def visualize(nodes, edges, title='Graph'):
 # Story Graph Class
 class StoryGraph:
     # This class defines a story graph 'soup' of entities and actions
+    # Nodes and edges are added incrementally and indexed by type/label and by adjacency.
+    # Every addition is appended to change_log, so the display graph, graphml export and
+    # export_delta only process what changed since they last ran.
     def __init__(self, title="Graph"):
         self.title = title # Title of the storygraph
         self.node_dict = dict() # dictionary of keys to nodes (for example, spacy tokens -> Nodes)
-        self.nodes = set() # might change to set
-        self.edges = set() # might change to set
+        self.key_to_node = dict() # node.key -> node. All other indexes use node.key
+        self.custom_keys = dict() # node.key -> node_dict keys pointing at that node
+        self.nodes = set()
+        self.edges = set()
+        self.edge_dict = dict() # edge tuple (label, source_key, dest_key) -> Edge
+        self.nodes_by_type = dict() # node type -> set of node keys
+        self.edges_by_label = dict() # edge label -> set of edge tuples
+        self.out_edges = dict() # node key -> set of edge tuples leaving it
+        self.in_edges = dict() # node key -> set of edge tuples entering it
+        self.change_log = [] # ('node', node key) or ('edge', edge tuple), in the order they changed
         self.display_graph = None
-    
+        self.display_version = 0 # change_log position the display graph has rendered up to
+        self.token_to_idx = dict() # node key -> display graph id
+        self.pending_edges = set() # edge tuples whose endpoints aren't displayed yet
+        self.rendered_edges = set() # edge tuples already in the display graph
+        self.nx_graph = None
+        self.nx_version = 0 # display edges already in nx_graph
+        self.nx_dirty = set() # display node ids added or updated since the last graphml export
+
+    @property
+    def version(self):
+        return len(self.change_log)
+
+    # Adds nodes, replacing any node with the same node.key
+    # A dict also maps custom keys (e.g. spacy tokens) to nodes in node_dict
     def add_nodes(self, nodes):
         assert type(nodes) in [dict, list, set]
-        if type(nodes) == dict:
-            self.node_dict = nodes
-            self.nodes = set([node for _, node in self.node_dict.items()])
-        else:
-            for node in nodes:
-                self.node_dict[node.key] = node
-            self.nodes = set(nodes)
-
+        items = nodes.items() if type(nodes) == dict else [(node.key, node) for node in nodes]
+        for custom_key, node in items:
+            self.custom_keys.setdefault(node.key, set()).add(custom_key)
+            previous = self.key_to_node.get(node.key)
+            if previous is node:
+                self.node_dict[custom_key] = node
+                continue
+            if previous is not None:
+                self.nodes.discard(previous)
+                self.nodes_by_type.get(previous.type, set()).discard(node.key)
+            # Every custom key of the replaced node now points at the new one
+            for key in self.custom_keys[node.key]:
+                self.node_dict[key] = node
+            self.key_to_node[node.key] = node
+            self.nodes.add(node)
+            self.nodes_by_type.setdefault(node.type, set()).add(node.key)
+            self.change_log.append(('node', node.key))
+
+    # Adds or replaces edges, identified by their (label, source_key, dest_key) tuple
     def add_edges(self, edges):
         assert type(edges) in [set, list]
-        self.edges = set(edges)
-
+        for edge in edges:
+            tup = edge.tup()
+            previous = self.edge_dict.get(tup)
+            if previous is edge:
+                continue
+            if previous is not None:
+                self.edges.discard(previous)
+            self.edge_dict[tup] = edge
+            self.edges.add(edge)
+            self.edges_by_label.setdefault(edge.label, set()).add(tup)
+            self.out_edges.setdefault(edge.source_key, set()).add(tup)
+            self.in_edges.setdefault(edge.dest_key, set()).add(tup)
+            self.change_log.append(('edge', tup))
+
+    # Index Methods
+    # Looks a node up by node.key, or by a custom key passed to add_nodes
+    def get_node(self, key):
+        node = self.key_to_node.get(key)
+        return node if node is not None else self.node_dict.get(key)
+
+    def nodes_of_type(self, node_type):
+        return [self.key_to_node[key] for key in self.nodes_by_type.get(node_type, set())]
+
+    def edges_with_label(self, label):
+        return [self.edge_dict[tup] for tup in self.edges_by_label.get(label, set())]
+
+    # Keys of the nodes connected to key. direction is 'out', 'in' or 'both'
+    def neighbors(self, key, direction='both'):
+        keys = set()
+        if direction in ['out', 'both']:
+            keys.update(dest for _, _, dest in self.out_edges.get(key, set()))
+        if direction in ['in', 'both']:
+            keys.update(source for _, source, _ in self.in_edges.get(key, set()))
+        return keys
+
+    # Delta Methods
+    # Returns the node keys and edge tuples changed since a change_log version
+    def changes_since(self, version=0):
+        node_keys, edge_tups = set(), set()
+        for kind, item in self.change_log[version:]:
+            if kind == 'node':
+                node_keys.add(item)
+            else:
+                edge_tups.add(item)
+        return node_keys, edge_tups
+
+    # Returns {'version': ..., 'nodes': [...], 'edges': [...]} with the to_dict() of everything changed since version
+    # Pass the returned version back in to get the next delta (e.g. for a live monitoring page)
+    def export_delta(self, since=0):
+        node_keys, edge_tups = self.changes_since(since)
+        nodes = [self.key_to_node[key].to_dict() for key in node_keys]
+        edges = [self.edge_dict[tup].to_dict() for tup in edge_tups]
+        return {'version': self.version, 'nodes': nodes, 'edges': edges}
+
+    # Builds the display graph on first call, afterwards only renders nodes and edges changed since the last call
     def build_display_graph(self):
-        print("Building Display Graph")
-        self.display_graph = Graph(self.title)
-        nodes = []
-        nodecount = 0
-        token_to_idx = dict()
-        for node in self.nodes:
-
-            nodes.append(GenericNode(nodecount, label=node.title, text=str(dict(node.attrs))))
-            token_to_idx[node.key] = nodecount
-            nodecount += 1
-
-        self.display_graph.addNodes(nodes)
-        
-        edges = [rel.tup() for rel in self.edges]
-        for name, src, dst in edges:
-            if src in token_to_idx.keys() and dst in token_to_idx.keys():
-                self.display_graph.addEdge(token_to_idx[src], token_to_idx[dst], label=name)
+        if self.display_graph is None:
+            print("Building Display Graph")
+            self.display_graph = Graph(self.title)
+            self.display_version = 0
+            self.token_to_idx = dict()
+            self.pending_edges = set()
+            self.rendered_edges = set()
+            self.nx_graph = None
+        node_keys, edge_tups = self.changes_since(self.display_version)
+        for key in node_keys:
+            node = self.key_to_node[key]
+            if key in self.token_to_idx:
+                self.display_graph.updateNode(GenericNode(self.token_to_idx[key], label=node.title, text=str(dict(node.attrs))))
             else:
-                print("Couldn't match relation between", src, dst)
-        # print(token_to_idx)
-        # G.visualize(self.title)
-        # return G.net
-    
+                self.token_to_idx[key] = len(self.token_to_idx)
+                self.display_graph.addNode(GenericNode(self.token_to_idx[key], label=node.title, text=str(dict(node.attrs))))
+            self.nx_dirty.add(self.token_to_idx[key])
+
+        # Edges to nodes that aren't in the graph yet wait until their endpoints are added
+        # Re-added edges keep their display edge, which only shows the label
+        rendered = []
+        for name, src, dst in (self.pending_edges | edge_tups) - self.rendered_edges:
+            if src in self.token_to_idx and dst in self.token_to_idx:
+                self.display_graph.addEdge(self.token_to_idx[src], self.token_to_idx[dst], label=name)
+                rendered.append((name, src, dst))
+            else:
+                self.pending_edges.add((name, src, dst))
+        self.pending_edges.difference_update(rendered)
+        self.rendered_edges.update(rendered)
+        if self.pending_edges:
+            print("Couldn't match {} relations to displayed nodes".format(len(self.pending_edges)))
+        self.display_version = self.version
+        return len(node_keys), len(rendered)
+
     def write_graph_ml(self):
         print("Writing graphml to", OUTPUT_PATH + self.title + ".xml")
-        if not self.display_graph:
-            self.build_display_graph()
-        nxGraph = pyviz_to_nx(self.display_graph.net)
-        nx.write_graphml(nxGraph, OUTPUT_PATH + self.title + ".xml")
+        self.build_display_graph()
+        net = self.display_graph.net
+        if self.nx_graph is None:
+            self.nx_graph = pyviz_to_nx(net)
+        else:
+            # Only carry over display nodes added or updated and edges added since the last export
+            node_index = self.display_graph.node_index
+            self.nx_graph.add_nodes_from([(idx, net.nodes[node_index[idx]]) for idx in self.nx_dirty])
+            self.nx_graph.add_edges_from([(attrs['from'], attrs['to'], attrs) for attrs in net.edges[self.nx_version:]])
+        self.nx_version = len(net.edges)
+        self.nx_dirty = set()
+        nx.write_graphml(self.nx_graph, OUTPUT_PATH + self.title + ".xml")
 
     def visualize(self):
         print("Visualizing Graph")
-        # print(self.nodes)
-        # print(self.node_dict)
-        # print(self.edges)
-        
-        if not self.display_graph:
-            self.build_display_graph()
+        self.build_display_graph()
         self.display_graph.visualize(OUTPUT_PATH + self.title)
         print("Saved graph at", OUTPUT_PATH + self.title + '.html')
 
@@ -102,6 +202,7 @@ class Graph:
         self.net.width = '1500px'
         self.net.height = '600px'
         self.root = None
+        self.node_index = dict() # node id -> position in net.nodes
 
     # def setRoot(self, root):
     #     self.root = root
@@ -121,6 +222,14 @@ class Graph:
                 label=genericNode.label,
                 shape=genericNode.shape,
                 title=genericNode.text)#, size=size)
+        self.node_index.setdefault(genericNode.id, len(self.net.nodes) - 1)
+
+    # Updates the label and text of a node that is already in the network
+    def updateNode(self, genericNode):
+        attrs = self.net.nodes[self.node_index[genericNode.id]]
+        attrs['label'] = genericNode.label
+        attrs['shape'] = genericNode.shape
+        attrs['title'] = genericNode.text
 
     def addNodeManually(self, id, label=None, text=None, shape='dot', size=50):
         # if self.net.get_node(id):